@@ -1,8 +1,18 @@
+import re
+
 from app.text import Text, Element
 
+TAG_DELIMITERS = re.compile("([<>])")
+# An attribute is a whitespace separated name=value pair or a bare name.
+ATTRIBUTE_PATTERN = re.compile(r"([^\s=]*)=(\S*)|(\S+)")
+ENTITIES = {"&lt;": "<", "&gt;": ">"}
+ENTITY_PATTERN = re.compile("|".join(ENTITIES))
+
 
 def unescape_entities(text):
-    return text.replace("&lt;", "<").replace("&gt;", ">")
+    if "&" not in text:
+        return text
+    return ENTITY_PATTERN.sub(lambda match: ENTITIES[match.group()], text)
 
 
 def transform(body):
@@ -32,41 +42,41 @@ class HTMLParser:
         self.unfinished = []
 
     def parse(self):
-        text = ""
         in_tag = False
         in_body = True
-        for char in self.body:
-            if char == "<":
+        # Split at every "<" and ">" in one go, so the text in between comes as whole slices.
+        parts = TAG_DELIMITERS.split(self.body)
+        for text, delimiter in zip(parts[0::2], parts[1::2]):
+            if delimiter == "<":
                 in_tag = True
                 if text and in_body:
                     self.add_text(unescape_entities(text))
-                text = ""
-            elif char == ">":
+            else:
                 in_tag = False
                 if text == self.IMPLICIT_TAGS[0]:
                     in_body = False
                 elif text == "/" + self.IMPLICIT_TAGS[0]:
                     in_body = True
                 self.add_tag(text)
-                text = ""
-            else:
-                text += char
+        text = parts[-1]
         if not in_tag and text:
             self.add_text(unescape_entities(text))
         return self.finish()
 
     def get_attributes(self, text):
-        parts = text.split()
+        parts = text.split(None, 1)
         tag = parts[0].lower()
         attributes = {}
-        for attr_val_pair in parts[1:]:
-            if "=" in attr_val_pair:
-                key, value = attr_val_pair.split("=", 1)
+        if len(parts) == 1:
+            return tag, attributes  # Most tags have no attributes.
+        # All pairs come out of one regular expression pass instead of being split one by one.
+        for key, value, name in ATTRIBUTE_PATTERN.findall(parts[1]):
+            if name:
+                attributes[name.lower()] = ""
+            else:
                 if len(value) > 2 and value[0] in ["'", "\""]:
                     value = value[1:-1]
                 attributes[key.lower()] = value
-            else:
-                attributes[attr_val_pair.lower()] = ""
         return tag, attributes
 
     def add_text(self, text):
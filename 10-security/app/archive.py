@@ -0,0 +1,58 @@
+import json
+import os
+import threading
+import time
+
+RECORD = "record"
+REPLAY = "replay"
+
+
+class ArchiveMiss(Exception):
+    pass
+
+
+# Stores network responses in a single JSON lines file and serves them again, keyed by method, url and body,
+# so that benchmarks can run without a network and see the same bytes every time.
+class NetworkArchive:
+    def __init__(self, path, mode, replay_latency=False):
+        assert mode in [RECORD, REPLAY], "Unknown archive mode '{}'.".format(mode)
+        self.path = path
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self.entries = {}
+        self.lock = threading.Lock()
+        if mode == REPLAY:
+            self.load()
+        elif os.path.exists(path):
+            os.remove(path)  # A recording always starts from an empty archive.
+
+    def load(self):
+        with open(self.path, encoding="UTF-8") as file:
+            for line in file:
+                entry = json.loads(line)
+                self.entries[(entry["method"], entry["url"], entry["payload"])] = entry
+
+    def is_replaying(self):
+        return self.mode == REPLAY
+
+    def record(self, method, url, payload, response_headers, body, elapsed):
+        entry = {
+            "method": method,
+            "url": url,
+            "payload": payload or "",
+            "headers": response_headers,
+            "body": body,
+            "elapsed": elapsed,
+        }
+        with self.lock:
+            self.entries[(method, url, payload or "")] = entry
+            with open(self.path, "a", encoding="UTF-8") as file:
+                file.write(json.dumps(entry) + "\n")
+
+    def replay(self, method, url, payload):
+        entry = self.entries.get((method, url, payload or ""))
+        if entry is None:
+            raise ArchiveMiss("{} {} is not in the archive.".format(method, url))
+        if self.replay_latency:
+            time.sleep(entry["elapsed"])
+        return dict(entry["headers"]), entry["body"]
@@ -0,0 +1,256 @@
+import asyncio
+import threading
+import time
+
+from app.connection import IDLE_TIMEOUT, MAX_CONNECTIONS_PER_HOST
+from app.resolver import ATTEMPT_DELAY, CONNECT_TIMEOUT
+from app.timing import TIMINGS, RequestTiming
+from app.tls import TLS_SESSIONS
+from app.url import CACHE, CHUNK_SIZE, CODEC, DEFAULT_LIMITS, FINAL_URL, NO_BODY_STATUSES, Decompressor, \
+    ResponseTooLarge, add_header, build_request, check_allowed, check_response, follow_redirect, keep_alive, \
+    may_retry, may_store, prepare_request, skip_known_redirects, split_host, split_scheme, store_cookies
+
+
+class AsyncConnection:
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+        self.last_used = time.monotonic()
+
+    def is_expired(self, now):
+        return now - self.last_used > IDLE_TIMEOUT or self.reader.at_eof()
+
+    def close(self):
+        self.writer.close()
+
+
+# Same idea as ConnectionPool, but waiting for a free connection suspends the coroutine instead of a thread.
+class AsyncConnectionPool:
+    def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST, connect_timeout=CONNECT_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.connect_timeout = connect_timeout
+        self.idle = {}
+        self.slots = {}
+
+    async def acquire(self, scheme, host, port, timing):
+        key = (scheme, host, port)
+        slots = self.slots.setdefault(key, asyncio.Semaphore(self.max_per_host))
+        await slots.acquire()
+
+        idle, now = self.idle.get(key, []), time.monotonic()
+        while idle:
+            connection = idle.pop()
+            if connection.is_expired(now):
+                connection.close()
+                continue
+            connection.reused = True
+            return connection
+
+        try:
+            # The event loop resolves the host and races its addresses itself, so "connect" includes DNS here.
+            start = time.monotonic()
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, happy_eyeballs_delay=ATTEMPT_DELAY), self.connect_timeout)
+            timing.record("connect", time.monotonic() - start)
+            if scheme == "https":
+                start = time.monotonic()
+                await writer.start_tls(TLS_SESSIONS.get_context(), server_hostname=host)
+                timing.record("tls", time.monotonic() - start)
+        except BaseException:
+            slots.release()
+            raise
+        return AsyncConnection(key, reader, writer)
+
+    def release(self, connection, reusable):
+        if reusable:
+            connection.last_used = time.monotonic()
+            self.idle.setdefault(connection.key, []).append(connection)
+        else:
+            connection.close()
+        self.slots[connection.key].release()
+
+    def stats(self):
+        return {"idle": sum(len(idle) for idle in self.idle.values())}
+
+    def close_all(self):
+        for idle in self.idle.values():
+            for connection in idle:
+                connection.close()
+        self.idle = {}
+
+
+async def connect_async(url, payload, limits, pool, top_level_url=None, allowed_origins=None):
+    # Follows redirects like open_stream() and returns the decoded body.
+    chain = []
+    while True:
+        url = skip_known_redirects(url, payload, chain)
+        check_allowed(url, allowed_origins)
+        timing = RequestTiming("POST" if payload else "GET", url)
+        timing.redirects = list(chain)
+        TIMINGS.append(timing)
+        try:
+            status, response_headers, body = await open_once_async(url, payload, limits, pool, timing, top_level_url)
+        finally:
+            timing.finish()
+        if body is not None:
+            if chain:
+                response_headers = dict(response_headers, **{FINAL_URL: url})
+            return response_headers, body.decode(CODEC)
+        url, payload = follow_redirect(url, payload, status, response_headers, chain)
+
+
+async def open_once_async(url, payload, limits, pool, timing, top_level_url=None):
+    scheme, rest, view_source = split_scheme(url)
+    host, port, path, encrypted = split_host(rest, scheme)
+    method = "POST" if payload else "GET"
+
+    entry, fresh, extra_headers = prepare_request(url, method, top_level_url, timing)
+    if fresh:
+        timing.bytes_decoded = len(entry.body)
+        return "200", entry.headers, entry.body
+
+    request_headers = build_request(host, method, path, payload, extra_headers)
+    while True:
+        connection = await pool.acquire(scheme, host, port, timing)
+        written = False
+        try:
+            sent = time.monotonic()
+            connection.writer.write(request_headers)
+            await connection.writer.drain()
+            written = True
+            status_line = (await connection.reader.readline()).decode(CODEC)
+            if not status_line:
+                raise ConnectionResetError("Connection closed by server.")
+            timing.record("ttfb", time.monotonic() - sent)
+        except OSError:
+            pool.release(connection, False)
+            if connection.reused and may_retry(method, written):  # See send_request().
+                continue
+            raise
+        except BaseException:
+            pool.release(connection, False)  # E.g. cancelled, see Fetcher.stop().
+            raise
+        break
+
+    try:
+        version, status, explanation = status_line.split(" ", 2)
+        response_headers = await read_headers_async(connection.reader)
+        store_cookies(url, response_headers)
+        timing.status = status
+        start = time.monotonic()
+        decompressor = Decompressor(response_headers.get("content-encoding", ""), limits.decompressed, timing)
+        pieces = []
+        async for chunk in read_body_async(connection.reader, status, response_headers, limits, timing):
+            pieces.extend(decompressor.decompress(chunk))
+        pieces.append(decompressor.flush())
+        timing.record("download", time.monotonic() - start)
+    except BaseException:
+        pool.release(connection, False)
+        raise
+    pool.release(connection, keep_alive(version, status, response_headers))
+    body = b"".join(pieces)
+
+    response = check_response(url, status, explanation.strip(), response_headers, entry, timing)
+    if response:
+        return response
+
+    timing.bytes_decoded = len(body)
+    if may_store(url, method, response_headers, timing):
+        if len(body) <= CACHE.max_entry_bytes:
+            CACHE.store(url, response_headers, body)
+        else:
+            CACHE.remove(url)
+    return status, response_headers, body
+
+
+async def read_headers_async(reader):
+    response_headers = {}
+    while True:
+        line = (await reader.readline()).decode(CODEC)
+        if line == "\r\n" or line == "":
+            break
+        header, value = line.split(":", 1)
+        add_header(response_headers, header.lower(), value.strip())
+    return response_headers
+
+
+async def read_body_async(reader, status, response_headers, limits, timing):
+    # Yields the raw body in the framing the server chose, like ResponseBody does for blocking sockets.
+    if status in NO_BODY_STATUSES:
+        return
+    received = 0
+
+    if "chunked" in response_headers.get("transfer-encoding", ""):
+        chunks = read_chunks_async(reader)
+    elif "content-length" in response_headers:
+        length = int(response_headers["content-length"])
+        if length > limits.compressed:
+            raise ResponseTooLarge("Response body of {} bytes exceeds the limit.".format(length))
+        chunks = read_exactly_async(reader, length)
+    else:
+        chunks = read_until_closed_async(reader)
+
+    async for chunk in chunks:
+        received += len(chunk)
+        timing.bytes_received = received
+        if received > limits.compressed:
+            raise ResponseTooLarge("Response body exceeds {} bytes.".format(limits.compressed))
+        yield chunk
+
+
+async def read_chunks_async(reader):
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            raise ConnectionResetError("Connection closed inside a chunked body.")
+        size = int(line.split(b";", 1)[0], 16)
+        if size == 0:
+            break
+        async for chunk in read_exactly_async(reader, size):
+            yield chunk
+        await reader.readexactly(2)  # CRLF after each chunk.
+    # Skip trailers up to the empty line that ends the body.
+    while (await reader.readline()) not in [b"\r\n", b"\n", b""]:
+        pass
+
+
+async def read_exactly_async(reader, length):
+    while length > 0:
+        chunk = await reader.readexactly(min(length, CHUNK_SIZE))
+        length -= len(chunk)
+        yield chunk
+
+
+async def read_until_closed_async(reader):
+    while True:
+        chunk = await reader.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+# Runs an asyncio event loop on a background thread. Requests from any thread become coroutines on it,
+# so many slow responses wait on one thread instead of one blocked worker thread each.
+class AsyncEngine:
+    def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST):
+        self.loop = asyncio.new_event_loop()
+        self.pool = AsyncConnectionPool(max_per_host)
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def submit(self, url, payload=None, limits=DEFAULT_LIMITS, top_level_url=None, allowed_origins=None):
+        # Returns a concurrent.futures.Future with (response headers, body).
+        coroutine = connect_async(url, payload, limits, self.pool, top_level_url, allowed_origins)
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def connect(self, url, payload=None, limits=DEFAULT_LIMITS, top_level_url=None, allowed_origins=None):
+        return self.submit(url, payload, limits, top_level_url, allowed_origins).result()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.close_pool(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def close_pool(self):
+        self.pool.close_all()
@@ -0,0 +1,72 @@
+from collections import OrderedDict
+
+from app.html_parser import document_order
+
+MAX_PAGES = 5
+MAX_BYTES = 64 * 1024 * 1024
+OBJECT_BYTES = 400  # Rough size of one DOM node, layout object or draw command including its dicts.
+
+
+# Everything needed to show a page again without loading, parsing, styling or laying it out.
+class PageState:
+    def __init__(self, tab):
+        self.url = tab.url
+        self.nodes = tab.nodes
+        self.rules = tab.rules
+        self.document = tab.document
+        self.display_list = tab.display_list
+        self.scroll = tab.scroll
+        self.y_max = tab.y_max
+        self.width = tab.width
+        self.height = tab.height
+        self.allowed_origins = tab.allowed_origins
+        self.js = tab.js
+        self.size = self.estimate_size()
+
+    def estimate_size(self):
+        objects = len(document_order(self.nodes))
+        if self.document:
+            objects += len(document_order(self.document))
+        objects += len(self.display_list or [])
+        return objects * OBJECT_BYTES
+
+    def restore(self, tab):
+        tab.url = self.url
+        tab.nodes = self.nodes
+        tab.rules = self.rules
+        tab.document = self.document
+        tab.display_list = self.display_list
+        tab.scroll = self.scroll
+        tab.y_max = self.y_max
+        tab.width = self.width
+        tab.height = self.height
+        tab.allowed_origins = self.allowed_origins
+        tab.js = self.js
+        tab.focus = None
+
+
+# Least recently used pages of a tab's history, bounded by page count and estimated memory.
+class BackForwardCache:
+    def __init__(self, max_pages=MAX_PAGES, max_bytes=MAX_BYTES):
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes
+        self.pages = OrderedDict()
+        self.bytes = 0
+
+    def store(self, tab):
+        self.take(tab.url)
+        page = PageState(tab)
+        if page.size > self.max_bytes:
+            return
+        self.pages[page.url] = page
+        self.bytes += page.size
+        while len(self.pages) > self.max_pages or self.bytes > self.max_bytes:
+            _, evicted = self.pages.popitem(last=False)
+            self.bytes -= evicted.size
+
+    def take(self, url):
+        # A restored page becomes the live page of the tab, so it leaves the cache.
+        page = self.pages.pop(url, None)
+        if page:
+            self.bytes -= page.size
+        return page
@@ -8,6 +8,9 @@ WIDTH, HEIGHT = 800, 600
 BG_COLOR, CHROME_FILL, CHROME_OUTLINE = "white", "white", "blue"
 BUTTON_WIDTH, TAB_WIDTH = 40, 80
 NEW_TAB_PAGE = "data:text/html,<h1>New Tab Page<h1>"
+# Milliseconds before background work like prefetching starts. Timers, unlike after_idle() callbacks, do not
+# run inside draw_partial(), so the work waits until the page has loaded.
+IDLE_DELAY = 100
 
 
 class Browser:
@@ -19,6 +22,9 @@ class Browser:
         self.width = WIDTH
         self.height = HEIGHT
         self.tabs = []
+        self.spare_tab = None  # Tab with the new tab page already rendered, see new_tab().
+        self.pointer = None
+        self.prefetch_scheduled = False
         self.address_bar = ""
         self.window = tkinter.Tk()
         self.window.bind("<Down>", self.handle_down)
@@ -28,6 +34,9 @@ class Browser:
         self.window.bind("<Key>", self.handle_key)
         self.window.bind("<Return>", self.handle_enter)
         self.window.bind("<BackSpace>", self.handle_backspace)
+        self.window.bind("<Alt-Left>", self.handle_back)
+        self.window.bind("<Alt-Right>", self.handle_forward)
+        self.window.bind("<Motion>", self.handle_motion)
         self.canvas = tkinter.Canvas(
             self.window,
             width=self.width,
@@ -36,19 +45,48 @@ class Browser:
         )
         self.canvas.pack(fill="both", expand=1)
         self.canvas.bind("<Configure>", self.configure)
+        self.window.after(IDLE_DELAY, self.prepare_spare_tab)
 
     def load(self, url):
         self.focus = None
         self.active_tab = len(self.tabs)
         new_tab = Tab(self)
-        new_tab.load(url)
         self.tabs.append(new_tab)
+        new_tab.load(url)
+
+    # Opening a tab only swaps in the spare one. A new spare is prepared once the browser is idle again.
+    def new_tab(self):
+        tab, self.spare_tab = self.spare_tab, None
+        if tab is None or tab.width != self.width or tab.height != self.height:
+            self.load(NEW_TAB_PAGE)
+            self.tabs[self.active_tab].render()
+        else:
+            self.focus = None
+            self.active_tab = len(self.tabs)
+            self.tabs.append(tab)
+        self.window.after(IDLE_DELAY, self.prepare_spare_tab)
+
+    def prepare_spare_tab(self):
+        if self.spare_tab is None:
+            tab = Tab(self)
+            tab.load(NEW_TAB_PAGE)
+            tab.render()
+            self.spare_tab = tab
+        elif self.spare_tab.width != self.width or self.spare_tab.height != self.height:
+            self.spare_tab.render()
+
+    # Shows a tab that is still loading without waiting for the event loop.
+    def draw_partial(self, tab):
+        if self.tabs[self.active_tab] is tab:
+            self.draw()
+            self.window.update_idletasks()
 
     def configure(self, event):
         self.height = event.height
         self.width = event.width
         self.tabs[self.active_tab].render()
         self.draw()
+        self.window.after(IDLE_DELAY, self.prepare_spare_tab)
 
     # Show document on canvas.
     def draw(self):
@@ -95,6 +133,23 @@ class Browser:
         self.canvas.create_rectangle(10, 50, 35, 90, outline=CHROME_OUTLINE, width=1)
         self.canvas.create_polygon(15, 70, 30, 55, 30, 85, fill=CHROME_OUTLINE)
 
+        self.schedule_prefetch()
+
+    # Prefetches links of the page on screen once the browser has nothing else to do.
+    def schedule_prefetch(self):
+        if not self.prefetch_scheduled:
+            self.prefetch_scheduled = True
+            self.window.after(IDLE_DELAY, self.prefetch_links)
+
+    def prefetch_links(self):
+        self.prefetch_scheduled = False
+        self.tabs[self.active_tab].prefetch_links(self.pointer)
+
+    def handle_motion(self, event):
+        self.pointer = (event.x, event.y - CHROME_PX) if event.y >= CHROME_PX else None
+        if self.pointer:
+            self.schedule_prefetch()
+
     def handle_down(self, event):
         self.tabs[self.active_tab].scroll_down(event)
         self.draw()
@@ -114,8 +169,7 @@ class Browser:
             if BUTTON_WIDTH <= event.x < BUTTON_WIDTH + TAB_WIDTH * len(self.tabs) and 0 <= event.y < 40:
                 self.active_tab = int((event.x - BUTTON_WIDTH) / TAB_WIDTH)
             elif 10 <= event.x < 30 and 10 <= event.y < 30:
-                self.load(NEW_TAB_PAGE)
-                self.tabs[self.active_tab].render()
+                self.new_tab()
             elif 10 <= event.x < 35 and 40 <= event.y < 90:  # Clicked on back button.
                 self.tabs[self.active_tab].go_back()
             elif 50 <= event.x < self.width - 10 and 40 <= event.y < 90:
@@ -145,6 +199,14 @@ class Browser:
             self.focus = None
             self.draw()
 
+    def handle_back(self, event):
+        self.tabs[self.active_tab].go_back()
+        self.draw()
+
+    def handle_forward(self, event):
+        self.tabs[self.active_tab].go_forward()
+        self.draw()
+
     def handle_backspace(self, event):
         if self.focus == "address bar":
             self.address_bar = self.address_bar[:-1]
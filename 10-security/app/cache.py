@@ -0,0 +1,204 @@
+import email.utils
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+MAX_CACHE_BYTES = 32 * 1024 * 1024
+MAX_ENTRY_BYTES = 2 * 1024 * 1024  # Larger responses are not stored, so a download never buffers more than this.
+HEURISTIC_FRACTION = 0.1  # Share of the Last-Modified age a response is considered fresh without explicit expiry.
+PREFETCH_LIFETIME = 300  # Seconds a prefetched response may be used once whatever its headers say.
+
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in value.split(","):
+        directive = directive.strip().lower()
+        if not directive:
+            continue
+        if "=" in directive:
+            name, arg = directive.split("=", 1)
+            directives[name.strip()] = arg.strip().strip("\"")
+        else:
+            directives[directive] = None
+    return directives
+
+
+def parse_http_date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class CacheEntry:
+    def __init__(self, headers, body, stored_at):
+        self.headers = headers
+        self.body = body
+        self.stored_at = stored_at
+        self.prefetched = False  # Cleared by the first load that uses it, see use().
+
+    def size(self):
+        return len(self.body)
+
+    def freshness_lifetime(self):
+        cache_control = parse_cache_control(self.headers.get("cache-control", ""))
+        if "no-cache" in cache_control:
+            return 0
+        if "max-age" in cache_control:
+            try:
+                return int(cache_control["max-age"])
+            except ValueError:
+                return 0
+        date = parse_http_date(self.headers.get("date")) or self.stored_at
+        if "expires" in self.headers:
+            expires = parse_http_date(self.headers["expires"])
+            return expires - date if expires else 0
+        if "last-modified" in self.headers:
+            last_modified = parse_http_date(self.headers["last-modified"])
+            if last_modified:
+                return (date - last_modified) * HEURISTIC_FRACTION
+        return 0
+
+    def age(self, now):
+        try:
+            initial_age = int(self.headers.get("age", 0))
+        except ValueError:
+            initial_age = 0
+        return initial_age + now - self.stored_at
+
+    def is_fresh(self, now):
+        if self.prefetched and now - self.stored_at < PREFETCH_LIFETIME:
+            return True
+        return self.age(now) < self.freshness_lifetime()
+
+    # Called when the entry is served. A prefetched response is only good for the load it was fetched for,
+    # later ones go by its headers again.
+    def use(self):
+        self.prefetched = False
+
+    def validators(self):
+        validators = {}
+        if "etag" in self.headers:
+            validators["If-None-Match"] = self.headers["etag"]
+        if "last-modified" in self.headers:
+            validators["If-Modified-Since"] = self.headers["last-modified"]
+        return validators
+
+
+# In-memory LRU cache of HTTP responses with an optional directory that keeps them across restarts.
+class HTTPCache:
+    def __init__(self, max_bytes=MAX_CACHE_BYTES, disk_path=None, max_entry_bytes=MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.disk_path = disk_path
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.counters = {"hits": 0, "misses": 0, "revalidations": 0}
+        self.lock = threading.RLock()
+        if disk_path:
+            os.makedirs(disk_path, exist_ok=True)
+
+    def lookup(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry:
+                self.entries.move_to_end(url)
+            elif self.disk_path:
+                entry = self.load_from_disk(url)
+                if entry:
+                    self.insert(url, entry)
+            return entry
+
+    def is_storable(self, headers):
+        cache_control = parse_cache_control(headers.get("cache-control", ""))
+        return "no-store" not in cache_control and headers.get("vary", "").strip() != "*"
+
+    def store(self, url, headers, body):
+        if not self.is_storable(headers):
+            self.remove(url)
+            return
+        entry = CacheEntry(headers, body, time.time())
+        with self.lock:
+            self.insert(url, entry)
+            if self.disk_path:
+                self.save_to_disk(url, entry)
+
+    def mark_prefetched(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry:
+                entry.prefetched = True
+
+    def refresh(self, url, entry, headers):
+        # A 304 response carries updated metadata for the stored body.
+        merged = dict(entry.headers)
+        merged.update(headers)
+        self.store(url, merged, entry.body)
+        return merged
+
+    def remove(self, url):
+        with self.lock:
+            entry = self.entries.pop(url, None)
+            if entry:
+                self.bytes -= entry.size()
+            if self.disk_path:
+                for path in self.disk_paths(url):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def insert(self, url, entry):
+        if entry.size() > self.max_entry_bytes:
+            return
+        old = self.entries.pop(url, None)
+        if old:
+            self.bytes -= old.size()
+        self.entries[url] = entry
+        self.bytes += entry.size()
+        # Evict least recently used entries until the byte budget is met.
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.size()
+
+    def disk_paths(self, url):
+        name = hashlib.sha1(url.encode("UTF-8")).hexdigest()
+        base = os.path.join(self.disk_path, name)
+        return base + ".json", base + ".body"
+
+    def save_to_disk(self, url, entry):
+        meta_path, body_path = self.disk_paths(url)
+        with open(body_path, "wb") as file:
+            file.write(entry.body)
+        with open(meta_path, "w", encoding="UTF-8") as file:
+            json.dump({"url": url, "headers": entry.headers, "stored_at": entry.stored_at}, file)
+
+    def load_from_disk(self, url):
+        meta_path, body_path = self.disk_paths(url)
+        try:
+            with open(meta_path, encoding="UTF-8") as file:
+                meta = json.load(file)
+            with open(body_path, "rb") as file:
+                body = file.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != url:
+            return None
+        return CacheEntry(meta["headers"], body, meta["stored_at"])
+
+    def record(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self.entries)
+            stats["bytes"] = self.bytes
+            return stats
+
+    def clear(self):
+        with self.lock:
+            for url in list(self.entries):
+                self.remove(url)
@@ -0,0 +1,58 @@
+import threading
+
+CANCEL_CHECK_INTERVAL = 0.05  # Seconds between checks whether a waiting caller was cancelled.
+
+
+class Cancelled(Exception):
+    pass
+
+
+class InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Lets concurrent callers asking for the same key share one call: the first caller runs it,
+# the others wait for its result or exception.
+class RequestCoalescer:
+    def __init__(self):
+        self.in_flight = {}
+        self.counters = {"requests": 0, "coalesced": 0}
+        self.lock = threading.Lock()
+
+    # A caller that waits for another one's result stops waiting once its cancelled event, if any, is set.
+    def run(self, key, function, cancelled=None):
+        with self.lock:
+            self.counters["requests"] += 1
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = InFlight()
+                self.in_flight[key] = flight
+            else:
+                self.counters["coalesced"] += 1
+
+        if not leader:
+            while not flight.done.wait(None if cancelled is None else CANCEL_CHECK_INTERVAL):
+                if cancelled.is_set():
+                    raise Cancelled("Stopped waiting for a shared call.")
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function()
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            flight.done.set()
+        return flight.result
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
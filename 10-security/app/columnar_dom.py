@@ -0,0 +1,202 @@
+from array import array
+
+from app.html_parser import HTMLParser
+from app.text import Text, Element
+
+NO_NODE = -1
+TEXT_TAG = 0  # Tag id of text nodes.
+
+
+# A whole DOM tree in a few typed arrays instead of one object per node. Node i is described by entry i of
+# every column. The text of all text nodes shares one string, and elements with equal attributes share one
+# interned attribute table. Nodes are only turned into objects, the views below, when they are looked at.
+class ColumnarDocument:
+    def __init__(self):
+        self.parents = array("i")
+        self.first_children = array("i")
+        self.last_children = array("i")  # Only needed to append children in constant time.
+        self.next_siblings = array("i")
+        self.tag_ids = array("i")
+        self.data = array("i")  # Offset into the text buffer for text nodes, attribute table id for elements.
+        self.lengths = array("i")  # Length of the text of text nodes.
+        self.tags = ["#text"]
+        self.tag_index = {}
+        self.attribute_tables = [()]
+        self.attribute_index = {(): 0}
+        self.buffer = ""
+        self.pending_text = []  # Text added since the buffer was last joined.
+        self.buffer_length = 0
+        self.styles = {}  # Computed style per node, set while styling like Element.style.
+
+    def __len__(self):
+        return len(self.tag_ids)
+
+    def add_node(self, tag_id, data, length, parent):
+        index = len(self.tag_ids)
+        self.parents.append(parent)
+        self.first_children.append(NO_NODE)
+        self.last_children.append(NO_NODE)
+        self.next_siblings.append(NO_NODE)
+        self.tag_ids.append(tag_id)
+        self.data.append(data)
+        self.lengths.append(length)
+        if parent != NO_NODE:
+            last = self.last_children[parent]
+            if last == NO_NODE:
+                self.first_children[parent] = index
+            else:
+                self.next_siblings[last] = index
+            self.last_children[parent] = index
+        return index
+
+    def add_element(self, tag, attributes, parent=NO_NODE):
+        tag_id = self.tag_index.get(tag)
+        if tag_id is None:
+            tag_id = self.tag_index[tag] = len(self.tags)
+            self.tags.append(tag)
+        return self.add_node(tag_id, self.intern_attributes(attributes), 0, parent)
+
+    def add_text(self, text, parent):
+        self.pending_text.append(text)
+        index = self.add_node(TEXT_TAG, self.buffer_length, len(text), parent)
+        self.buffer_length += len(text)
+        return index
+
+    def intern_attributes(self, attributes):
+        table = tuple(attributes.items())
+        table_id = self.attribute_index.get(table)
+        if table_id is None:
+            table_id = self.attribute_index[table] = len(self.attribute_tables)
+            self.attribute_tables.append(table)
+        return table_id
+
+    def join_text(self):
+        # One string instead of one per text node.
+        if self.pending_text:
+            self.buffer += "".join(self.pending_text)
+            self.pending_text = []
+
+    def text_of(self, index):
+        self.join_text()
+        start = self.data[index]
+        return self.buffer[start:start + self.lengths[index]]
+
+    def child_indices(self, index):
+        child = self.first_children[index]
+        while child != NO_NODE:
+            yield child
+            child = self.next_siblings[child]
+
+    def view(self, index):
+        if index == NO_NODE:
+            return None
+        if self.tag_ids[index] == TEXT_TAG:
+            return TextView(self, index)
+        return ElementView(self, index)
+
+    def stats(self):
+        columns = [self.parents, self.first_children, self.last_children, self.next_siblings, self.tag_ids,
+                   self.data, self.lengths]
+        return {
+            "nodes": len(self),
+            "tags": len(self.tags) - 1,
+            "attribute tables": len(self.attribute_tables),
+            "column bytes": sum(column.itemsize * len(column) for column in columns),
+            "text characters": self.buffer_length,
+        }
+
+
+# Views are made on demand and compare equal when they show the same node, so they work as dictionary keys
+# and in comparisons like the Element objects they stand in for. They subclass Text and Element, so
+# isinstance() checks in the rest of the browser do not have to know about them.
+class NodeView:
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return isinstance(other, NodeView) and other.document is self.document and other.index == self.index
+
+    def __hash__(self):
+        return hash((id(self.document), self.index))
+
+    @property
+    def parent(self):
+        return self.document.view(self.document.parents[self.index])
+
+    @property
+    def children(self):
+        return [self.document.view(child) for child in self.document.child_indices(self.index)]
+
+    @children.setter
+    def children(self, children):
+        raise Exception("A columnar document can not be restructured.")
+
+    @property
+    def style(self):
+        return self.document.styles.setdefault(self.index, {})
+
+    @style.setter
+    def style(self, style):
+        self.document.styles[self.index] = style
+
+
+class TextView(NodeView, Text):
+    __slots__ = ("document", "index")
+
+    def __init__(self, document, index):
+        self.document = document
+        self.index = index
+
+    @property
+    def text(self):
+        return self.document.text_of(self.index)
+
+
+class ElementView(NodeView, Element):
+    __slots__ = ("document", "index")
+
+    def __init__(self, document, index):
+        self.document = document
+        self.index = index
+
+    @property
+    def tag(self):
+        return self.document.tags[self.document.tag_ids[self.index]]
+
+    @property
+    def attributes(self):
+        return Attributes(self.document, self.index)
+
+
+# The attributes of an element as a dict. Writes go back to the document, which interns the changed table.
+class Attributes(dict):
+    def __init__(self, document, index):
+        super().__init__(document.attribute_tables[document.data[index]])
+        self.document = document
+        self.index = index
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.document.data[self.index] = self.document.intern_attributes(self)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.document.data[self.index] = self.document.intern_attributes(self)
+
+
+# Builds a ColumnarDocument instead of Element and Text objects. Everything else works as in HTMLParser.
+class ColumnarHTMLParser(HTMLParser):
+    def __init__(self, body=""):
+        super().__init__(body)
+        self.document = ColumnarDocument()
+
+    def close(self):
+        root = super().close()
+        self.document.join_text()
+        return root
+
+    def create_text(self, text, parent):
+        return TextView(self.document, self.document.add_text(text, parent.index))
+
+    def create_element(self, tag, attributes, parent):
+        index = self.document.add_element(tag, attributes, parent.index if parent else NO_NODE)
+        return ElementView(self.document, index)
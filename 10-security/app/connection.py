@@ -0,0 +1,150 @@
+import socket
+import threading
+import time
+
+from app.resolver import CONNECT_TIMEOUT, RESOLVER, connect_racing
+from app.tls import TLS_SESSIONS
+
+MAX_CONNECTIONS_PER_HOST = 6
+IDLE_TIMEOUT = 30  # Seconds an unused connection is kept open.
+
+
+class Connection:
+    def __init__(self, host, port, encrypted, connect_timeout=CONNECT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.encrypted = encrypted
+        self.reused = False
+        self.last_used = time.monotonic()
+        self.setup = {}  # Durations of the phases needed to open this connection.
+
+        start = time.monotonic()
+        addresses = RESOLVER.resolve(host, port)
+        resolved = time.monotonic()
+        soc = connect_racing(addresses, connect_timeout)
+        connected = time.monotonic()
+        self.setup["dns"] = resolved - start
+        self.setup["connect"] = connected - resolved
+
+        # Encrypted connection:
+        if encrypted:
+            soc, self.setup["tls"] = TLS_SESSIONS.wrap(soc, host, port)
+
+        self.socket = soc
+        self.response = soc.makefile("rb")
+
+    def send(self, data):
+        self.socket.sendall(data)
+
+    def is_expired(self, now):
+        return now - self.last_used > IDLE_TIMEOUT
+
+    def remember_session(self):
+        if self.encrypted:
+            TLS_SESSIONS.remember(self.socket, self.host, self.port)
+
+    def shut_down(self):
+        # Unlike close(), this also wakes up a thread that is blocked reading from the socket.
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.response.close()
+        self.socket.close()
+
+
+# Keeps persistent HTTP/1.1 connections per (scheme, host, port) so that
+# subsequent requests to the same server skip the TCP and TLS handshakes.
+class ConnectionPool:
+    def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST, connect_timeout=CONNECT_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.connect_timeout = connect_timeout
+        self.idle = {}
+        self.active = {}
+        self.owners = {}  # Thread -> the connection it is using, so abort() can reach it.
+        self.aborted = set()  # Threads whose requests were aborted, see abort().
+        self.condition = threading.Condition()
+
+    def acquire(self, scheme, host, port):
+        key, thread = (scheme, host, port), threading.current_thread()
+        with self.condition:
+            while True:
+                if thread in self.aborted:
+                    raise ConnectionAbortedError("Request was aborted.")
+                self.evict_expired()
+                idle = self.idle.get(key, [])
+                if idle:
+                    connection = idle.pop()
+                    connection.reused = True
+                    self.active[key] = self.active.get(key, 0) + 1
+                    self.owners[thread] = connection
+                    return connection
+                if self.active.get(key, 0) < self.max_per_host:
+                    self.active[key] = self.active.get(key, 0) + 1
+                    break
+                # Wait until another request to this host returns its connection.
+                self.condition.wait()
+
+        try:
+            connection = Connection(host, port, scheme == "https", self.connect_timeout)
+        except Exception:
+            with self.condition:
+                self.active[key] -= 1
+                self.condition.notify_all()
+            raise
+        with self.condition:
+            self.owners[thread] = connection
+        if thread in self.aborted:
+            connection.shut_down()  # Aborted while connecting.
+        return connection
+
+    def release(self, connection, reusable):
+        key = ("https" if connection.encrypted else "http", connection.host, connection.port)
+        connection.remember_session()
+        with self.condition:
+            self.active[key] -= 1
+            for thread in [thread for thread, owned in self.owners.items() if owned is connection]:
+                del self.owners[thread]
+            if reusable:
+                connection.last_used = time.monotonic()
+                self.idle.setdefault(key, []).append(connection)
+            else:
+                connection.close()
+            self.condition.notify_all()
+
+    # Makes the requests of thread fail right away, including one blocked reading from a server that hangs.
+    # The thread gets no connections until clear_abort() is called for it.
+    def abort(self, thread):
+        with self.condition:
+            self.aborted.add(thread)
+            connection = self.owners.get(thread)
+            if connection:
+                connection.shut_down()
+            self.condition.notify_all()
+
+    def clear_abort(self, thread):
+        with self.condition:
+            self.aborted.discard(thread)
+
+    def evict_expired(self):
+        now = time.monotonic()
+        for key, idle in self.idle.items():
+            for connection in [c for c in idle if c.is_expired(now)]:
+                idle.remove(connection)
+                connection.close()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "active": sum(self.active.values()),
+                "idle": sum(len(idle) for idle in self.idle.values()),
+            }
+
+    def close_all(self):
+        with self.condition:
+            for idle in self.idle.values():
+                for connection in idle:
+                    connection.close()
+            self.idle = {}
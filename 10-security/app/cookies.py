@@ -0,0 +1,261 @@
+import ipaddress
+import json
+import os
+import threading
+import time
+
+from app.cache import parse_http_date
+
+SAME_SITE_VALUES = ["strict", "lax", "none"]
+DEFAULT_SAME_SITE = "lax"
+COMPACT_FACTOR = 2  # Rewrite the cookie file once it holds this many lines per stored cookie.
+
+
+class Cookie:
+    def __init__(self, name, value, domain, path, expires=None, host_only=True, secure=False, http_only=False,
+                 same_site=DEFAULT_SAME_SITE, created=None):
+        self.name = name
+        self.value = value
+        self.domain = domain
+        self.path = path
+        self.expires = expires  # None for session cookies, which are never written to disk.
+        self.host_only = host_only  # Set without a Domain attribute, so only sent to exactly this host.
+        self.secure = secure
+        self.http_only = http_only
+        self.same_site = same_site
+        self.created = created or time.time()
+
+    def key(self):
+        return self.name, self.domain, self.path
+
+    def is_expired(self, now):
+        return self.expires is not None and self.expires <= now
+
+    def matches_domain(self, host):
+        if self.host_only:
+            return host == self.domain
+        return host == self.domain or host.endswith("." + self.domain)
+
+    def to_list(self):
+        return [self.name, self.value, self.domain, self.path, self.expires, self.host_only, self.secure,
+                self.http_only, self.same_site, self.created]
+
+
+def is_ip_address(host):
+    # Host names end in a letter, so most of them are told apart without parsing.
+    if not host[-1:].isdigit() and ":" not in host:
+        return False
+    try:
+        ipaddress.ip_address(host.strip("[]"))
+        return True
+    except ValueError:
+        return False
+
+
+# There is no public suffix list here, so the last two labels are taken as the registrable domain.
+def registrable_domain(host):
+    if is_ip_address(host):
+        return host
+    return ".".join(host.split(".")[-2:])
+
+
+def default_path(path):
+    path = path.split("?", 1)[0]
+    if not path.startswith("/") or path.count("/") == 1:
+        return "/"
+    return path[:path.rindex("/")]
+
+
+def path_prefixes(path):
+    # "/a/b/c" is matched by cookies for "/", "/a", "/a/", "/a/b", "/a/b/" and "/a/b/c".
+    path = path.split("?", 1)[0] or "/"
+    prefixes = ["/"]
+    for i, char in enumerate(path):
+        if char == "/" and i > 0:
+            prefixes.extend([path[:i], path[:i + 1]])
+    if path not in prefixes:
+        prefixes.append(path)
+    return prefixes
+
+
+def parse_set_cookie(header, host, path, now):
+    # Returns a Cookie, or None if the header is malformed or names a domain the host may not set.
+    pair, *attributes = header.split(";")
+    if "=" not in pair:
+        return None
+    name, value = pair.split("=", 1)
+    name, value = name.strip(), value.strip()
+    if not name:
+        return None
+
+    cookie = Cookie(name, value, host, default_path(path))
+    max_age = None
+    for attribute in attributes:
+        attribute_name, _, attribute_value = attribute.partition("=")
+        attribute_name, attribute_value = attribute_name.strip().lower(), attribute_value.strip()
+        if attribute_name == "domain" and attribute_value:
+            domain = attribute_value.lstrip(".").lower()
+            if host != domain and (is_ip_address(host) or not host.endswith("." + domain)):
+                return None
+            if "." not in domain and domain != host:
+                return None  # A top-level domain such as "com".
+            cookie.domain = domain
+            cookie.host_only = False
+        elif attribute_name == "path" and attribute_value.startswith("/"):
+            cookie.path = attribute_value
+        elif attribute_name == "expires":
+            cookie.expires = parse_http_date(attribute_value)
+        elif attribute_name == "max-age":
+            try:
+                max_age = int(attribute_value)
+            except ValueError:
+                pass
+        elif attribute_name == "secure":
+            cookie.secure = True
+        elif attribute_name == "httponly":
+            cookie.http_only = True
+        elif attribute_name == "samesite" and attribute_value.lower() in SAME_SITE_VALUES:
+            cookie.same_site = attribute_value.lower()
+    # Max-Age wins over Expires.
+    if max_age is not None:
+        cookie.expires = now + max_age
+    return cookie
+
+
+def parse_lines(lines):
+    entries = []
+    for line in lines:
+        try:
+            entries.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return entries
+
+
+# Stores cookies by registrable domain and path, so a request only looks at the cookies that can match it.
+# Persistent cookies are appended to a file of JSON lines as they change and read back on startup.
+class CookieJar:
+    def __init__(self, path=None):
+        self.path = path
+        self.domains = {}  # registrable domain -> path -> (name, domain, path) -> Cookie
+        self.count = 0
+        self.lines = 0  # Lines in the cookie file, to know when it is worth compacting.
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def store(self, set_cookie_headers, scheme, host, path):
+        now = time.time()
+        with self.lock:
+            for header in set_cookie_headers:
+                cookie = parse_set_cookie(header, host, path, now)
+                if cookie is None or cookie.secure and scheme != "https":
+                    continue
+                old = self.remove(cookie)
+                if old:
+                    cookie.created = old.created  # Keeps the order in which cookies are sent.
+                if cookie.is_expired(now):
+                    self.append(cookie.key(), None)  # An expired cookie deletes the stored one.
+                    continue
+                self.insert(cookie)
+                if cookie.expires is not None or old and old.expires is not None:
+                    self.append(cookie.key(), cookie if cookie.expires is not None else None)
+
+    def cookies_for(self, scheme, host, path, same_site=True, method="GET"):
+        # Cookies for a request, most specific path first. Cross-site requests only get SameSite=None
+        # cookies, and Lax ones as well if they are GETs.
+        now = time.time()
+        cookies, expired = [], []
+        with self.lock:
+            paths = self.domains.get(registrable_domain(host), {})
+            for prefix in path_prefixes(path):
+                for cookie in paths.get(prefix, {}).values():
+                    if cookie.is_expired(now):
+                        expired.append(cookie)
+                    elif not cookie.matches_domain(host) or cookie.secure and scheme != "https":
+                        continue
+                    elif same_site or cookie.same_site == "none" or \
+                            cookie.same_site == "lax" and method == "GET":
+                        cookies.append(cookie)
+            for cookie in expired:
+                self.remove(cookie)
+                self.append(cookie.key(), None)
+        cookies.sort(key=lambda cookie: (-len(cookie.path), cookie.created))
+        return cookies
+
+    def header(self, scheme, host, path, same_site=True, method="GET"):
+        cookies = self.cookies_for(scheme, host, path, same_site, method)
+        return "; ".join("{}={}".format(cookie.name, cookie.value) for cookie in cookies)
+
+    def insert(self, cookie):
+        paths = self.domains.setdefault(registrable_domain(cookie.domain), {})
+        paths.setdefault(cookie.path, {})[cookie.key()] = cookie
+        self.count += 1
+
+    def remove(self, cookie):
+        paths = self.domains.get(registrable_domain(cookie.domain), {})
+        cookies = paths.get(cookie.path, {})
+        old = cookies.pop(cookie.key(), None)
+        if old:
+            self.count -= 1
+            if not cookies:
+                del paths[cookie.path]
+        return old
+
+    def append(self, key, cookie):
+        # A line holds a cookie as a list, or [name, null, domain, path] to delete one.
+        if not self.path:
+            return
+        if cookie:
+            line = cookie.to_list()
+        else:
+            line = [key[0], None, key[1], key[2]]
+        with open(self.path, "a", encoding="UTF-8") as file:
+            file.write(json.dumps(line, separators=(",", ":")) + "\n")
+        self.lines += 1
+
+    def load(self):
+        now = time.time()
+        with open(self.path, encoding="UTF-8") as file:
+            lines = file.read().splitlines()
+        # One json.loads call for the whole file is much faster than one per line. A broken line, e.g. one cut
+        # off by a crash, makes it fail, so then the lines are parsed one by one and the broken ones dropped.
+        try:
+            entries, broken = json.loads("[" + ",".join(lines) + "]"), False
+        except json.JSONDecodeError:
+            entries, broken = parse_lines(lines), True
+        for fields in entries:
+            self.lines += 1
+            cookie = Cookie(*fields) if fields[1] is not None else Cookie(fields[0], None, fields[2], fields[3])
+            self.remove(cookie)
+            if cookie.value is not None and not cookie.is_expired(now):
+                self.insert(cookie)
+        if broken or self.lines > COMPACT_FACTOR * max(self.count, 1):
+            self.compact()
+
+    def compact(self):
+        # Rewrites the file with only the cookies that are still stored.
+        temporary_path = self.path + ".tmp"
+        lines = 0
+        with open(temporary_path, "w", encoding="UTF-8") as file:
+            for cookie in self.all_cookies():
+                if cookie.expires is not None:
+                    file.write(json.dumps(cookie.to_list(), separators=(",", ":")) + "\n")
+                    lines += 1
+        os.replace(temporary_path, self.path)
+        self.lines = lines
+
+    def all_cookies(self):
+        return [cookie for paths in self.domains.values() for cookies in paths.values()
+                for cookie in cookies.values()]
+
+    def stats(self):
+        with self.lock:
+            return {"cookies": self.count, "domains": len(self.domains)}
+
+    def clear(self):
+        with self.lock:
+            self.domains = {}
+            self.count = 0
+            if self.path:
+                self.compact()
@@ -1,4 +1,4 @@
-from app.selector import TagSelector, DescendantSelector
+from app.selector import DescendantSelector, simple_selector
 from app.text import Element
 
 INHERITED_PROPERTIES = {
@@ -67,11 +67,10 @@ class CSSParser:
         return pairs
 
     def selector(self):
-        out = TagSelector(self.word().lower())
+        out = simple_selector(self.word())
         self.whitespace()
         while self.i < len(self.s) and self.s[self.i] != "{":
-            tag = self.word()
-            descendant = TagSelector(tag.lower())
+            descendant = simple_selector(self.word())
             out = DescendantSelector(out, descendant)
             self.whitespace()
         return out
@@ -0,0 +1,271 @@
+import heapq
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from app.coalescer import Cancelled
+from app.url import COALESCER, DEFAULT_LIMITS, POOL, coalescing_key, fetch_async, is_async, is_streamed, split_scheme, \
+    stream, url_origin
+
+MAX_WORKERS = 8
+MAX_FETCHES_PER_HOST = 4
+RESOURCE_TIMEOUT = 10  # Seconds to wait for a batch of subresources, see fetch_all().
+
+# Priority classes, most important first. Navigations do not go through the queue; the tab streams them itself.
+RENDER_BLOCKING = 1  # Style sheets and scripts of the page that is shown.
+XHR = 2
+PREFETCH = 3
+BACKGROUND = 4  # Anything for a tab that is not shown.
+
+
+class FetchCancelled(Exception):
+    pass
+
+
+def host_key(url):
+    try:
+        return url_origin(url)
+    except ValueError:
+        return url
+
+
+class Job:
+    def __init__(self, future, url, top_level_url, payload, priority, group, limits=DEFAULT_LIMITS,
+                 allowed_origins=None):
+        self.future = future
+        self.url = url
+        self.top_level_url = top_level_url
+        self.payload = payload
+        self.limits = limits
+        self.allowed_origins = allowed_origins  # Checked for every url on the way, see request().
+        self.priority = priority
+        self.group = group  # Whatever the fetch belongs to, usually a tab, so it can be cancelled with it.
+        self.host = host_key(url)
+        self.cancelled = threading.Event()
+        self.thread = None  # The worker running the job.
+        self.request = None  # Or the request on the asyncio engine it waits for, see start_request().
+
+
+class EngineRequest:
+    def __init__(self, key, future):
+        self.key = key
+        self.future = future
+        self.jobs = []  # Jobs sharing the request.
+
+
+# Runs requests on a bounded pool of worker threads, most important first. Fetches beyond the per-host
+# limit wait without occupying a worker, so a slow host cannot starve the others.
+class Fetcher:
+    def __init__(self, max_workers=MAX_WORKERS, max_per_host=MAX_FETCHES_PER_HOST):
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.running = {}  # Number of running jobs per host.
+        self.active = set()
+        self.waiting = []  # Heap of (priority, sequence, job); the sequence keeps equal priorities in order.
+        self.sequence = 0
+        self.requests = {}  # GETs on the asyncio engine by coalescing key.
+
+    def submit(self, url, top_level_url=None, payload=None, priority=RENDER_BLOCKING, group=None,
+               limits=DEFAULT_LIMITS, allowed_origins=None):
+        future = Future()
+        job = Job(future, url, top_level_url, payload, priority, group, limits, allowed_origins)
+        with self.lock:
+            heapq.heappush(self.waiting, (priority, self.sequence, job))
+            self.sequence += 1
+        self.dispatch()
+        return future
+
+    def dispatch(self):
+        # Start the most important waiting jobs whose host still has a free slot.
+        started, skipped = [], []
+        with self.lock:
+            while self.waiting and len(self.active) < self.max_workers:
+                entry = heapq.heappop(self.waiting)
+                job = entry[2]
+                if job.future.cancelled():
+                    continue
+                if self.running.get(job.host, 0) >= self.max_per_host:
+                    skipped.append(entry)
+                    continue
+                self.running[job.host] = self.running.get(job.host, 0) + 1
+                self.active.add(job)
+                started.append(job)
+            for entry in skipped:
+                heapq.heappush(self.waiting, entry)
+        for job in started:
+            if is_async(split_scheme(job.url)[0]):
+                self.start_request(job)
+            else:
+                self.executor.submit(self.run, job)
+
+    def run(self, job):
+        job.thread = threading.current_thread()
+        try:
+            if job.future.set_running_or_notify_cancel():
+                try:
+                    job.future.set_result(self.fetch(job))
+                except Exception as exception:
+                    job.future.set_exception(exception)
+        finally:
+            self.finish(job)
+            POOL.clear_abort(job.thread)  # After finish(), so a late stop() cannot hit the next job.
+
+    def start_request(self, job):
+        # On the asyncio backend the fetch is a coroutine on the engine's event loop, so no worker waits for it.
+        # Concurrent GETs for the same url share one request, like in fetch().
+        if not job.future.set_running_or_notify_cancel():
+            self.finish(job)
+            return
+        scheme, rest, view_source = split_scheme(job.url)
+        key = coalescing_key(scheme + ":" + rest, job.top_level_url, job.limits, job.allowed_origins)
+        with self.lock:
+            cancelled = job.cancelled.is_set()
+            request = None if cancelled or job.payload else self.requests.get(key)
+            started = not cancelled and request is None
+            if started:
+                request = EngineRequest(key, fetch_async(scheme + ":" + rest, job.top_level_url, job.payload,
+                                                         job.limits, job.allowed_origins))
+                if not job.payload:
+                    self.requests[key] = request
+            if not cancelled:
+                request.jobs.append(job)
+                job.request = request
+        if cancelled:
+            job.future.set_exception(FetchCancelled("Fetch of {} was cancelled.".format(job.url)))
+            self.finish(job)
+        elif started:
+            request.future.add_done_callback(lambda future: self.request_done(request))
+
+    def request_done(self, request):
+        # Runs on the event loop's thread, or on the thread that cancelled the request.
+        with self.lock:
+            if self.requests.get(request.key) is request:
+                del self.requests[request.key]
+            jobs, request.jobs = request.jobs, []
+        for job in jobs:
+            if request.future.cancelled():
+                job.future.set_exception(FetchCancelled("Fetch of {} was cancelled.".format(job.url)))
+            elif request.future.exception() is not None:
+                job.future.set_exception(request.future.exception())
+            else:
+                response_headers, body = request.future.result()
+                job.future.set_result((dict(response_headers), body, split_scheme(job.url)[2]))
+            self.finish(job)
+
+    def fetch(self, job):
+        scheme, rest, view_source = split_scheme(job.url)
+        if job.payload or not is_streamed(scheme):
+            return self.read(job)  # stream() goes through request() then, which coalesces GETs itself.
+        # Concurrent GETs for the same url share one transaction, also with request() calls.
+        key = coalescing_key(scheme + ":" + rest, job.top_level_url, job.limits, job.allowed_origins)
+        while True:
+            try:
+                response_headers, body = COALESCER.run(key, lambda: self.read(job)[:2], job.cancelled)
+            except Cancelled:
+                raise FetchCancelled("Fetch of {} was cancelled.".format(job.url))
+            except FetchCancelled:
+                if job.cancelled.is_set():
+                    raise
+                continue  # The fetch this one waited for was cancelled, but this one was not.
+            return dict(response_headers), body, view_source
+
+    def read(self, job):
+        # The body is streamed, so a cancelled fetch stops at the next chunk and its connection is closed.
+        # stop() also shuts down the connection, for servers that do not send anything anymore.
+        try:
+            if job.cancelled.is_set():
+                raise FetchCancelled("Fetch of {} was cancelled.".format(job.url))
+            response_headers, chunks, view_source = stream(job.url, job.top_level_url, job.payload, job.limits,
+                                                           job.allowed_origins)
+            body = []
+            for chunk in chunks:
+                if job.cancelled.is_set():
+                    if hasattr(chunks, "close"):
+                        chunks.close()  # Closes the connection instead of reading the rest of the body.
+                    raise FetchCancelled("Fetch of {} was cancelled.".format(job.url))
+                body.append(chunk)
+        except Exception:
+            if job.cancelled.is_set():
+                raise FetchCancelled("Fetch of {} was cancelled.".format(job.url))
+            raise
+        return response_headers, "".join(body), view_source
+
+    def finish(self, job):
+        with self.lock:
+            self.running[job.host] -= 1
+            self.active.discard(job)
+        self.dispatch()
+
+    def cancel(self, group):
+        # Drops the waiting fetches of group and stops its running ones.
+        if group is None:
+            return
+        with self.lock:
+            cancelled = [entry[2] for entry in self.waiting if entry[2].group is group]
+            self.waiting = [entry for entry in self.waiting if entry[2].group is not group]
+            heapq.heapify(self.waiting)
+            stopped = [job for job in self.active if job.group is group]
+            for job in stopped:
+                self.stop(job)
+        for job in cancelled:
+            job.future.cancel()
+        for job in stopped:
+            self.cancel_request(job)
+
+    def cancel_fetch(self, future):
+        # Like cancel(), but for the one fetch behind future.
+        with self.lock:
+            stopped = [job for job in self.active if job.future is future]
+            for job in stopped:
+                self.stop(job)
+        future.cancel()  # Drops it if it still waits.
+        for job in stopped:
+            self.cancel_request(job)
+
+    def stop(self, job):
+        # Called with the lock held, so the job is still running on job.thread.
+        job.cancelled.set()
+        if job.thread is not None:
+            POOL.abort(job.thread)
+
+    def cancel_request(self, job):
+        # Called after stop() without the lock, as the job is finished here. The request on the asyncio engine
+        # is cancelled, which closes its connection, unless other jobs still wait for it.
+        with self.lock:
+            request = job.request
+            if request is None or job not in request.jobs:
+                return
+            request.jobs.remove(job)
+            last = not request.jobs
+            if last and self.requests.get(request.key) is request:
+                del self.requests[request.key]
+        if last:
+            request.future.cancel()
+        job.future.set_exception(FetchCancelled("Fetch of {} was cancelled.".format(job.url)))
+        self.finish(job)
+
+    def stats(self):
+        with self.lock:
+            return {"running": len(self.active), "waiting": len(self.waiting)}
+
+    def fetch_all(self, urls, top_level_url=None, timeout=RESOURCE_TIMEOUT, started=None,
+                  priority=RENDER_BLOCKING, group=None, allowed_origins=None):
+        # Yields (url, response or exception) in the order the urls were given. All of them share one
+        # deadline, and fetches still unfinished at it are cancelled so they give up their worker.
+        # Fetches that are already in flight, e.g. from the preload scanner, are passed in started.
+        deadline = time.monotonic() + timeout
+        started = started or {}
+        futures = [(url, started.get(url) or self.submit(url, top_level_url, None, priority, group,
+                                                         allowed_origins=allowed_origins))
+                   for url in urls]
+        for url, future in futures:
+            try:
+                yield url, future.result(timeout=max(deadline - time.monotonic(), 0))
+            except Exception as exception:
+                self.cancel_fetch(future)
+                yield url, exception
+
+
+FETCHER = Fetcher()
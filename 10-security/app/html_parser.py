@@ -1,8 +1,21 @@
+import re
+import weakref
+
 from app.text import Text, Element
 
+TAG_DELIMITERS = re.compile("([<>])")
+# An attribute is a whitespace separated name=value pair or a bare name.
+ATTRIBUTE_PATTERN = re.compile(r"([^\s=]*)=(\S*)|(\S+)")
+ENTITIES = {"&lt;": "<", "&gt;": ">"}
+ENTITY_PATTERN = re.compile("|".join(ENTITIES))
+ORDERS = weakref.WeakKeyDictionary()  # Cached document order per tree root, see document_order().
+INDEXES = weakref.WeakKeyDictionary()  # ElementIndex per tree root, see element_index().
+
 
 def unescape_entities(text):
-    return text.replace("&lt;", "<").replace("&gt;", ">")
+    if "&" not in text:
+        return text
+    return ENTITY_PATTERN.sub(lambda match: ENTITIES[match.group()], text)
 
 
 def transform(body):
@@ -11,18 +24,158 @@ def transform(body):
 
 # Pretty printer for parser tree.
 def print_tree(node, indent=0):
-    print(" " * indent, node)
-    for child in node.children:
-        print_tree(child, indent + 2)
+    stack = [(node, indent)]
+    while stack:
+        node, indent = stack.pop()
+        print(" " * indent, node)
+        stack.extend((child, indent + 2) for child in reversed(node.children))
+
+
+# Yields a node and all its descendants in document order. A stack instead of recursion
+# keeps deep pages from hitting the recursion limit.
+def walk(tree):
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children))
 
 
 def tree_to_list(tree, lst):
-    lst.append(tree)
-    for child in tree.children:
-        tree_to_list(child, lst)
+    lst.extend(walk(tree))
     return lst
 
 
+# All nodes of a DOM or layout tree in document order. The list is built once per tree and must not be changed;
+# code that changes the structure of a tree calls invalidate_order() on it.
+def document_order(tree):
+    order = ORDERS.get(tree)
+    if order is None:
+        order = ORDERS[tree] = list(walk(tree))
+    return order
+
+
+def invalidate_order(node):
+    while node.parent:
+        node = node.parent
+    ORDERS.pop(node, None)
+
+
+# Live sets of the elements of one document by tag, id and class, so finding them does not need a tree walk.
+# Dicts are used as sets because they keep elements in the order they were added. That is document order
+# while parsing. Sets that get elements out of order later are sorted again when they are next looked up.
+class ElementIndex:
+    def __init__(self):
+        self.tags = {}
+        self.ids = {}
+        self.classes = {}
+        self.unsorted = set()  # (table, key) of the sets that are not in document order.
+        self.positions = None  # Position of every node, built from document_order() for sorting.
+        self.positions_order = None  # The document_order() list the positions were built from.
+
+    def add(self, element, in_order=True):
+        tag = element.tag
+        elements = self.tags.get(tag)
+        if elements is None:
+            elements = self.tags[tag] = {}
+        elements[element] = None
+        if not in_order:
+            self.unsorted.add(("tags", tag))
+        if element.attributes:
+            self.add_attributes(element, in_order)
+
+    def remove(self, element):
+        self.discard(self.tags, element.tag, element)
+        self.remove_attributes(element)
+
+    def add_attributes(self, element, in_order=True):
+        if "id" in element.attributes:
+            self.insert("ids", element.attributes["id"], element, in_order)
+        for name in element.attributes.get("class", "").split():
+            self.insert("classes", name, element, in_order)
+
+    def remove_attributes(self, element):
+        if "id" in element.attributes:
+            self.discard(self.ids, element.attributes["id"], element)
+        for name in element.attributes.get("class", "").split():
+            self.discard(self.classes, name, element)
+
+    def insert(self, table, key, element, in_order):
+        getattr(self, table).setdefault(key, {})[element] = None
+        if not in_order:
+            self.unsorted.add((table, key))
+
+    def discard(self, elements_by_key, key, element):
+        elements = elements_by_key.get(key, {})
+        elements.pop(element, None)
+        if not elements:
+            elements_by_key.pop(key, None)
+
+    # For subtrees that are inserted into or removed from the document after parsing.
+    def add_tree(self, node):
+        for node in walk(node):
+            if isinstance(node, Element):
+                self.add(node, in_order=False)
+
+    def remove_tree(self, node):
+        for node in walk(node):
+            if isinstance(node, Element):
+                self.remove(node)
+
+    def by_tag(self, tag):
+        return self.lookup("tags", tag)
+
+    def by_id(self, id):
+        return self.lookup("ids", id)
+
+    def by_class(self, name):
+        return self.lookup("classes", name)
+
+    def lookup(self, table, key):
+        elements = getattr(self, table).get(key, {})
+        if (table, key) in self.unsorted:
+            self.unsorted.discard((table, key))
+            if len(elements) > 1:
+                elements = getattr(self, table)[key] = dict.fromkeys(self.sort(elements))
+        return list(elements)
+
+    def sort(self, elements):
+        root = next(iter(elements))
+        while root.parent:
+            root = root.parent
+        order = document_order(root)
+        if order is not self.positions_order:
+            self.positions = {node: position for position, node in enumerate(order)}
+            self.positions_order = order
+        return sorted(elements, key=self.positions.get)
+
+
+# The index of the document a node is part of. Trees that were not made by HTMLParser are indexed on first use.
+def element_index(node):
+    while node.parent:
+        node = node.parent
+    index = INDEXES.get(node)
+    if index is None:
+        index = INDEXES[node] = ElementIndex()
+        for element in walk(node):
+            if isinstance(element, Element):
+                index.add(element)
+    return index
+
+
+INDEXED_ATTRIBUTES = ["id", "class"]
+
+
+# Attribute writes on a parsed document go through here to keep its index up to date.
+def set_attribute(element, name, value):
+    index = element_index(element) if name in INDEXED_ATTRIBUTES else None
+    if index:
+        index.remove_attributes(element)
+    element.attributes[name] = value
+    if index:
+        index.add_attributes(element, in_order=False)
+
+
 class HTMLParser:
     SELF_CLOSING_TAGS = [
         "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr",
@@ -33,56 +186,83 @@ class HTMLParser:
     IMPLICIT_TAGS = [
         "head", "body", "/html",
     ]
+    # Insertion modes. Which implicit tags a token needs only depends on the first two open elements.
+    INITIAL = "initial"  # Nothing is open yet.
+    BEFORE_HEAD = "before head"  # Only html is open.
+    IN_HEAD = "in head"  # html and head are open.
+    IN_BODY = "in body"  # Anything else.
 
-    def __init__(self, body):
+    def __init__(self, body=""):
         self.body = body
         self.unfinished = []
+        self.open_counts = {}  # Number of open elements per tag, to match end tags without searching the stack.
+        self.mode = self.INITIAL
+        self.index = ElementIndex()
+        self.text = ""
+        self.in_tag = False
+        self.in_body = True
 
     def parse(self):
-        text = ""
-        in_tag = False
-        in_body = True
-        for char in self.body:
-            if char == "<":
-                in_tag = True
-                if text and in_body:
+        self.feed(self.body)
+        return self.close()
+
+    # Parses the next piece of the document. Open elements and unfinished text are kept until more input arrives.
+    def feed(self, chunk):
+        # Split at every "<" and ">" in one go, so the text in between comes as whole slices.
+        parts = TAG_DELIMITERS.split(chunk)
+        parts[0] = self.text + parts[0]
+        for text, delimiter in zip(parts[0::2], parts[1::2]):
+            if delimiter == "<":
+                self.in_tag = True
+                if text and self.in_body:
                     self.add_text(unescape_entities(text))
-                text = ""
-            elif char == ">":
-                in_tag = False
+            else:
+                self.in_tag = False
                 if text == self.IMPLICIT_TAGS[0]:
-                    in_body = False
+                    self.in_body = False
                 elif text == "/" + self.IMPLICIT_TAGS[0]:
-                    in_body = True
+                    self.in_body = True
                 self.add_tag(text)
-                text = ""
-            else:
-                text += char
-        if not in_tag and text:
-            self.add_text(unescape_entities(text))
-        return self.finish()
+        self.text = parts[-1]
+
+    def close(self):
+        if not self.in_tag and self.text:
+            self.add_text(unescape_entities(self.text))
+        self.text = ""
+        root = self.finish()
+        invalidate_order(root)  # A partial tree may have been walked already.
+        INDEXES[root] = self.index
+        return root
+
+    # The document as parsed so far, with all open elements already attached to their parents.
+    def partial_tree(self):
+        if not self.unfinished:
+            return None
+        invalidate_order(self.unfinished[0])
+        INDEXES[self.unfinished[0]] = self.index
+        return self.unfinished[0]
 
     def get_attributes(self, text):
-        parts = text.split()
+        parts = text.split(None, 1)
         tag = parts[0].lower()
         attributes = {}
-        for attr_val_pair in parts[1:]:
-            if "=" in attr_val_pair:
-                key, value = attr_val_pair.split("=", 1)
+        if len(parts) == 1:
+            return tag, attributes  # Most tags have no attributes.
+        # All pairs come out of one regular expression pass instead of being split one by one.
+        for key, value, name in ATTRIBUTE_PATTERN.findall(parts[1]):
+            if name:
+                attributes[name.lower()] = ""
+            else:
                 if len(value) > 2 and value[0] in ["'", "\""]:
                     value = value[1:-1]
                 attributes[key.lower()] = value
-            else:
-                attributes[attr_val_pair.lower()] = ""
         return tag, attributes
 
     def add_text(self, text):
         if text.isspace():
             return
         self.implicit_tags(None)
-        parent = self.unfinished[-1]  # Add a text node as a child of the last unfinished node.
-        node = Text(text, parent)
-        parent.children.append(node)
+        self.create_text(text, self.unfinished[-1])  # Add a text node as a child of the last unfinished node.
 
     def add_tag(self, tag):
         tag, attributes = self.get_attributes(tag)
@@ -90,31 +270,67 @@ class HTMLParser:
             return
         self.implicit_tags(tag)
         if tag.startswith("/"):
-            if len(self.unfinished) == 1:
-                return
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+            self.close_element(tag[1:])
         elif tag in self.SELF_CLOSING_TAGS:
-            parent = self.unfinished[-1]
-            node = Element(tag, attributes, parent)
-            parent.children.append(node)
+            self.index.add(self.create_element(tag, attributes, self.unfinished[-1]))
         else:
             parent = self.unfinished[-1] if self.unfinished else None
-            node = Element(tag, attributes, parent)
-            self.unfinished.append(node)
+            node = self.create_element(tag, attributes, parent)
+            self.index.add(node)
+            self.push(node)
+
+    # Nodes are made and attached here, so a parser for another kind of DOM only has to override these two.
+    def create_text(self, text, parent):
+        node = Text(text, parent)
+        parent.children.append(node)
+        return node
+
+    def create_element(self, tag, attributes, parent):
+        node = Element(tag, attributes, parent)
+        if parent:
+            parent.children.append(node)  # Attach immediately so partial trees can be rendered.
+        return node
+
+    def push(self, node):
+        self.unfinished.append(node)
+        self.open_counts[node.tag] = self.open_counts.get(node.tag, 0) + 1
+        self.update_mode()
+
+    def pop(self):
+        node = self.unfinished.pop()
+        self.open_counts[node.tag] -= 1
+        self.update_mode()
+        return node
+
+    def update_mode(self):
+        depth = len(self.unfinished)
+        if depth == 0:
+            self.mode = self.INITIAL
+        elif depth == 1:
+            self.mode = self.BEFORE_HEAD
+        elif depth == 2 and self.unfinished[1].tag == "head":
+            self.mode = self.IN_HEAD
+        else:
+            self.mode = self.IN_BODY
+
+    # An end tag closes the innermost open element with its name and everything opened inside of it.
+    # End tags without such an element are ignored, and html and body stay open until the document ends.
+    def close_element(self, tag):
+        if tag in ["html", "body"] or not self.open_counts.get(tag):
+            return
+        while self.pop().tag != tag:
+            pass
 
     def implicit_tags(self, tag):
         while True:
-            open_tags = [node.tag for node in self.unfinished]
-            if open_tags == [] and tag != "html":
+            if self.mode == self.INITIAL and tag != "html":
                 self.add_tag("html")
-            elif open_tags == ["html"] and tag not in self.IMPLICIT_TAGS:
+            elif self.mode == self.BEFORE_HEAD and tag not in self.IMPLICIT_TAGS:
                 if tag in self.HEAD_TAGS:
                     self.add_tag("head")
                 else:
                     self.add_tag("body")
-            elif open_tags == ["html", "head"] and tag not in ["/head"] + self.HEAD_TAGS:
+            elif self.mode == self.IN_HEAD and tag != "/head" and tag not in self.HEAD_TAGS:
                 self.add_tag("/head")
             else:
                 break
@@ -123,7 +339,5 @@ class HTMLParser:
         if len(self.unfinished) == 0:
             self.add_tag("html")
         while len(self.unfinished) > 1:
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
-        return self.unfinished.pop()
+            self.pop()
+        return self.pop()
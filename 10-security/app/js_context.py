@@ -1,8 +1,9 @@
 import dukpy
 
 from app.css_parser import CSSParser
-from app.html_parser import tree_to_list, HTMLParser
-from app.url import request, resolve_url, url_origin
+from app.fetcher import FETCHER, XHR
+from app.html_parser import HTMLParser, element_index, invalidate_order
+from app.url import FINAL_URL, resolve_url, url_origin
 
 EVENT_DISPATCH_CODE = "new Node(dukpy.handle).dispatchEvent(new Event(dukpy.type))"
 
@@ -47,7 +48,7 @@ class JSContext:
     def querySelectorAll(self, selector_text):
         selector = CSSParser(selector_text).selector()
         nodes = [node for node
-                 in tree_to_list(self.tab.nodes, [])
+                 in selector.candidates(element_index(self.tab.nodes))
                  if selector.matches(node)]
         return [self.get_handle(node) for node in nodes]
 
@@ -59,16 +60,24 @@ class JSContext:
         doc = HTMLParser("<html><body>" + string + "</body></html>").parse()
         new_nodes = doc.children[0].children
         element = self.handle_to_node[handle]
+        index = element_index(element)
+        for child in element.children:
+            index.remove_tree(child)
         element.children = new_nodes
         for child in element.children:
             child.parent = element
+            index.add_tree(child)
+        invalidate_order(element)
         self.tab.render()
 
     def XMLHttpRequest_send(self, method, url, body):
         full_url = resolve_url(url, self.tab.url)
         if not self.tab.allowed_request(full_url):  # Resolve relative URLs to know if they're allowed.
             raise Exception("Cross-origin XHR blocked by CSP")
-        response_headers, out = request(full_url, self.tab.url, payload=body)
+        future = FETCHER.submit(full_url, self.tab.url, body, self.tab.fetch_priority(XHR), self.tab,
+                                allowed_origins=self.tab.allowed_origins)
+        response_headers, out, view_source = future.result()
+        full_url = response_headers.get(FINAL_URL, full_url)  # A redirect may lead to another origin.
         if url_origin(full_url) != url_origin(self.tab.url):
             raise Exception("Cross-origin XHR request not allowed")
         return out
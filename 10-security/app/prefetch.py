@@ -0,0 +1,111 @@
+import threading
+
+from app.fetcher import FETCHER, PREFETCH
+from app.html_parser import document_order
+from app.text import Element
+from app.url import CACHE, Limits, ResponseTooLarge, resolve_url, url_origin
+
+MAX_PREFETCHES = 5  # Per page.
+MAX_PREFETCH_BYTES = 1024 * 1024  # Per page.
+
+
+def link_of(node):
+    # The href of the link a node is part of, if any.
+    while node:
+        if isinstance(node, Element) and node.tag == "a" and "href" in node.attributes:
+            return node.attributes["href"]
+        node = node.parent
+    return None
+
+
+# Fetches the same-origin links a user is likely to click next into the HTTP cache, one at a time and with
+# the lowest priority. The link under the pointer goes first, then the links on screen in document order.
+class LinkPrefetcher:
+    def __init__(self, tab):
+        self.tab = tab
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # Called on navigation. The running prefetch is cancelled together with the other fetches of the tab.
+        with self.lock:
+            self.queue = []
+            self.seen = set()
+            self.started = 0
+            self.bytes = 0
+            self.in_flight = None
+
+    def prefetch(self, pointer=None):
+        if self.tab.document is None or self.exhausted():
+            return
+        objs = document_order(self.tab.document)
+        if pointer:
+            x, y = pointer[0], pointer[1] + self.tab.scroll
+            for obj in reversed(objs):
+                if obj.x <= x < obj.x + obj.width and obj.y <= y < obj.y + obj.height:
+                    self.add(link_of(obj.node), first=True)
+                    break
+        top, bottom = self.tab.scroll, self.tab.scroll + self.tab.visible_height()
+        for obj in objs:
+            if not obj.children and obj.y + obj.height >= top and obj.y <= bottom:
+                self.add(link_of(obj.node))
+        self.next()
+
+    def add(self, link, first=False):
+        if link is None:
+            return
+        try:
+            url = resolve_url(link, self.tab.url)
+            same_origin = url.startswith("http") and url_origin(url) == url_origin(self.tab.url)
+        except ValueError:
+            return
+        if not same_origin or url == self.tab.url or not self.tab.allowed_request(url):
+            return
+        with self.lock:
+            if url in self.seen:
+                return
+            self.seen.add(url)
+            if first:
+                self.queue.insert(0, url)
+            else:
+                self.queue.append(url)
+
+    def next(self):
+        with self.lock:
+            if self.in_flight or not self.queue:
+                return
+            if self.exhausted():
+                return
+            url = self.queue.pop(0)
+            self.started += 1
+            # What is left of the budget is the most a single prefetch may download.
+            remaining = MAX_PREFETCH_BYTES - self.bytes
+            limits = Limits(remaining, remaining)
+            future = self.in_flight = FETCHER.submit(url, self.tab.url, None, PREFETCH, self.tab, limits,
+                                                     self.tab.allowed_origins)
+        future.add_done_callback(lambda future: self.done(url, future))
+
+    def exhausted(self):
+        return self.started >= MAX_PREFETCHES or self.bytes >= MAX_PREFETCH_BYTES
+
+    def done(self, url, future):
+        # Runs on a fetcher thread.
+        with self.lock:
+            if future is not self.in_flight:
+                return  # Left over from the previous page.
+            self.in_flight = None
+            if future.cancelled():
+                return
+            if isinstance(future.exception(), ResponseTooLarge):
+                self.bytes = MAX_PREFETCH_BYTES  # A page too large for the rest of the budget ends prefetching.
+            if future.exception():
+                return
+            response_headers, body, view_source = future.result()
+            self.bytes += len(body)
+        CACHE.mark_prefetched(url)
+        self.next()
+
+
+def was_prefetched(url):
+    entry = CACHE.lookup(url)
+    return entry is not None and entry.prefetched
@@ -0,0 +1,51 @@
+import re
+
+from app.fetcher import FETCHER, RENDER_BLOCKING
+from app.html_parser import HTMLParser
+from app.url import resolve_url
+
+TAG_PATTERN = re.compile(r"<(link|script)\s[^>]*>", re.IGNORECASE)
+MAX_PENDING = 4096  # Longest unfinished tag kept between chunks.
+
+
+# Looks for style sheets and scripts in the raw document text and starts fetching them
+# before the parser reaches them. Started fetches are collected in preloads by url.
+class PreloadScanner:
+    def __init__(self, tab, base_url, preloads):
+        self.tab = tab
+        self.base_url = base_url
+        self.preloads = preloads
+        self.pending = ""
+        self.parser = HTMLParser()
+
+    def feed(self, chunk):
+        text = self.pending + chunk
+        end = 0
+        for match in TAG_PATTERN.finditer(text):
+            self.found(match.group(0)[1:-1])
+            end = match.end()
+
+        # Keep a tag that is cut off at the end of the chunk for the next one.
+        start = text.rfind("<", end)
+        if start >= 0 and ">" not in text[start:] and len(text) - start <= MAX_PENDING:
+            self.pending = text[start:]
+        else:
+            self.pending = ""
+
+    def found(self, tag_text):
+        tag, attributes = self.parser.get_attributes(tag_text)
+        if tag == "link" and attributes.get("rel") == "stylesheet" and "href" in attributes:
+            self.preload(attributes["href"])
+        elif tag == "script" and "src" in attributes:
+            self.preload(attributes["src"])
+
+    def preload(self, link):
+        try:
+            url = resolve_url(link, self.base_url)
+        except ValueError:
+            return
+        if url in self.preloads or not self.tab.allowed_request(url):
+            return
+        priority = self.tab.fetch_priority(RENDER_BLOCKING)
+        self.preloads[url] = FETCHER.submit(url, self.base_url, None, priority, self.tab,
+                                            allowed_origins=self.tab.allowed_origins)
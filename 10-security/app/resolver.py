@@ -0,0 +1,116 @@
+import queue
+import socket
+import threading
+import time
+
+DNS_TTL = 60  # getaddrinfo does not report record TTLs, so every lookup is kept this long.
+NEGATIVE_TTL = 10  # Seconds a failed lookup is remembered.
+CONNECT_TIMEOUT = 10
+ATTEMPT_DELAY = 0.25  # Head start of each address before the next one is tried in parallel.
+
+
+# Caches getaddrinfo results, including failures, per (host, port).
+class Resolver:
+    def __init__(self, ttl=DNS_TTL, negative_ttl=NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, host, port):
+        key = (host, port)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and entry[0] > now:
+            if isinstance(entry[1], Exception):
+                raise entry[1]
+            return entry[1]
+
+        try:
+            infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP)
+        except socket.gaierror as error:
+            with self.lock:
+                self.entries[key] = (now + self.negative_ttl, error)
+            raise
+        addresses = interleave_families([(info[0], info[4]) for info in infos])
+        with self.lock:
+            self.entries[key] = (now + self.ttl, addresses)
+        return addresses
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+
+def interleave_families(addresses):
+    # Alternate IPv6 and IPv4 addresses, starting with IPv6, so a broken family costs one attempt delay.
+    ipv6 = [address for address in addresses if address[0] == socket.AF_INET6]
+    other = [address for address in addresses if address[0] != socket.AF_INET6]
+    ordered = []
+    for i in range(max(len(ipv6), len(other))):
+        ordered.extend(ipv6[i:i + 1] + other[i:i + 1])
+    return ordered
+
+
+# Connects to the first address that answers. Each further address is tried once the previous attempt
+# failed or has not succeeded within attempt_delay, in the style of happy eyeballs (RFC 8305).
+def connect_racing(addresses, timeout=CONNECT_TIMEOUT, attempt_delay=ATTEMPT_DELAY):
+    results = queue.Queue()
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def attempt(family, address):
+        soc = socket.socket(family=family, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP)
+        soc.settimeout(timeout)
+        try:
+            soc.connect(address)
+        except OSError as error:
+            soc.close()
+            results.put((None, error))
+            return
+        with lock:
+            if done.is_set():
+                soc.close()  # Another attempt already won.
+            else:
+                results.put((soc, None))
+
+    pending = list(addresses)
+    running = 0
+    error = OSError("No addresses to connect to.")
+    deadline = time.monotonic() + timeout
+    winner = None
+    while pending or running:
+        if pending:
+            family, address = pending.pop(0)
+            threading.Thread(target=attempt, args=(family, address), daemon=True).start()
+            running += 1
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            error = socket.timeout("Connecting timed out.")
+            break
+        try:
+            soc, attempt_error = results.get(timeout=min(attempt_delay, remaining) if pending else remaining)
+        except queue.Empty:
+            continue
+        running -= 1
+        if soc:
+            winner = soc
+            break
+        error = attempt_error
+
+    with lock:
+        done.set()
+    # Close sockets of attempts that succeeded at the same time as the winner.
+    while not results.empty():
+        soc, _ = results.get()
+        if soc:
+            soc.close()
+
+    if not winner:
+        raise error
+    winner.settimeout(None)
+    return winner
+
+
+RESOLVER = Resolver()
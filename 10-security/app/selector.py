@@ -9,6 +9,34 @@ class TagSelector:
     def matches(self, node):
         return isinstance(node, Element) and self.tag == node.tag
 
+    # The elements that may match, taken from an ElementIndex.
+    def candidates(self, index):
+        return index.by_tag(self.tag)
+
+
+class IdSelector:
+    def __init__(self, id):
+        self.id = id
+        self.priority = 100
+
+    def matches(self, node):
+        return isinstance(node, Element) and node.attributes.get("id") == self.id
+
+    def candidates(self, index):
+        return index.by_id(self.id)
+
+
+class ClassSelector:
+    def __init__(self, name):
+        self.name = name
+        self.priority = 10
+
+    def matches(self, node):
+        return isinstance(node, Element) and self.name in node.attributes.get("class", "").split()
+
+    def candidates(self, index):
+        return index.by_class(self.name)
+
 
 class DescendantSelector:
     def __init__(self, ancestor, descendant):
@@ -25,6 +53,17 @@ class DescendantSelector:
             node = node.parent
         return False
 
+    def candidates(self, index):
+        return self.descendant.candidates(index)
+
+
+def simple_selector(word):
+    if word.startswith("#"):
+        return IdSelector(word[1:])
+    if word.startswith("."):
+        return ClassSelector(word[1:])
+    return TagSelector(word.lower())
+
 
 def cascade_priority(rule):
     selector, body = rule
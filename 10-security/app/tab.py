@@ -1,40 +1,43 @@
+import html
+import time
 import urllib.parse
 
 import dukpy
 
+from app.bfcache import BackForwardCache
+from app.columnar_dom import ColumnarHTMLParser
 from app.css_parser import CSSParser, style
-from app.html_parser import HTMLParser, transform, tree_to_list, print_tree
+from app.fetcher import BACKGROUND, FETCHER, RENDER_BLOCKING
+from app.html_parser import HTMLParser, document_order, element_index, set_attribute, transform, walk, print_tree
 from app.js_context import JSContext
 from app.layout import DocumentLayout
+from app.prefetch import LinkPrefetcher, was_prefetched
+from app.preload import PreloadScanner
 from app.selector import cascade_priority
 from app.text import Text, Element
-from app.url import request
+from app.timing import NAVIGATIONS
+from app.url import FINAL_URL, ResponseTooLarge, stream, resolve_url, url_origin
 
 STYLE_SHEET_PATH = "../files/browser.css"
 SCROLL_STEP = 60
 CHROME_PX = 100
+ERROR_PAGE = "<h1>This page could not be loaded</h1><p>{}</p><p>{}</p>"
+DEFAULT_STYLE_SHEET = None  # Parsed once and shared by all tabs.
+# Parse pages into a ColumnarDocument, which takes far less memory for very large pages.
+# Styling and layout get slower though, and scripts can not replace the content of elements.
+COLUMNAR_DOM = False
 
 
-def resolve_url(url, current):
-    if "://" in url:
-        return url
-    elif url.startswith("/"):
-        scheme, host_path = current.split("://", 1)
-        host, old_path = host_path.split("/", 1)
-        return scheme + "://" + host + url
-    else:
-        directory, _ = current.rsplit("/", 1)
-        while url.startswith("../"):
-            url = url[3:]
-            if directory.count("/") == 2:
-                continue
-            directory, _ = directory.rsplit("/", 1)
-        return directory + "/" + url
+def default_style_sheet():
+    global DEFAULT_STYLE_SHEET
+    if DEFAULT_STYLE_SHEET is None:
+        with open(STYLE_SHEET_PATH) as file:
+            DEFAULT_STYLE_SHEET = CSSParser(file.read()).parse()
+    return DEFAULT_STYLE_SHEET
 
 
-def url_origin(url):
-    scheme_colon, _, host, _ = url.split("/", 3)
-    return scheme_colon + "//" + host
+def new_parser():
+    return ColumnarHTMLParser() if COLUMNAR_DOM else HTMLParser()
 
 
 class Tab:
@@ -50,31 +53,79 @@ class Tab:
         self.browser = browser
         self.display_list = None
         self.history = []
+        self.forward = []
+        self.bfcache = BackForwardCache()
+        self.preloads = {}
+        self.prefetcher = LinkPrefetcher(self)
         self.url = ""
         self.scroll, self.y_min, self.y_max = 0, 0, 0
-        with open(STYLE_SHEET_PATH) as file:
-            self.default_style_sheet = CSSParser(file.read()).parse()
+        self.default_style_sheet = default_style_sheet()
 
 
     def load(self, url, request_body=None):
+        self.save_page()
+        self.forward = []
+        self.history.append(url)
+        self.load_document(url, request_body)
+
+    def load_document(self, url, request_body=None):
+        FETCHER.cancel(self)  # The old page's fetches are of no use anymore.
+        self.prefetcher.reset()
         self.focus = None
         self.url = url  # Top level url
-        response_headers, body, view_source = request(url, self.url, request_body)
-        self.history.append(url)
-        if view_source:
-            self.nodes = HTMLParser(transform(body)).parse()
-        else:
-            self.nodes = HTMLParser(body).parse()
-        self.add_allowed_origins(response_headers)
+        self.preloads = {}
+        parser = new_parser()
+        try:
+            response_headers, chunks, view_source = stream(url, self.url, request_body)
+            self.add_allowed_origins(response_headers)
+            if FINAL_URL in response_headers:
+                # Relative links of a redirected page are resolved against where it came from.
+                url = self.url = self.history[-1] = response_headers[FINAL_URL]
+
+            # Parse the document while it downloads and paint the first screenful as soon as it is available.
+            scanner = PreloadScanner(self, url, self.preloads)
+            painted = False
+            chunk = next(chunks, None)
+            while chunk is not None:
+                if not view_source:
+                    scanner.feed(chunk)
+                parser.feed(transform(chunk) if view_source else chunk)
+                chunk = next(chunks, None)
+                if chunk is not None and not painted:
+                    painted = self.paint_partial(parser.partial_tree())
+        except ResponseTooLarge as error:
+            # Stop the load instead of buffering an unbounded body.
+            parser = new_parser()
+            parser.feed(ERROR_PAGE.format(html.escape(url), html.escape(str(error))))
+        self.nodes = parser.close()
         self.rules = self.extend_rules(url)
 
+    def paint_partial(self, nodes):
+        if nodes is None:
+            return False
+        self.nodes = nodes
+        self.rules = self.default_style_sheet
+        self.render()
+        if self.document.height < self.browser.height - CHROME_PX:
+            return False
+        self.browser.draw_partial(self)
+        return True
+
+    # Fetches of tabs that are not shown wait behind everything else.
+    def fetch_priority(self, priority):
+        tabs = self.browser.tabs
+        if self.browser.active_tab is not None and self.browser.active_tab < len(tabs) \
+                and tabs[self.browser.active_tab] is self:
+            return priority
+        return BACKGROUND
+
     # Support for the Content-Security-Policy header
     def add_allowed_origins(self, response_headers):
         self.allowed_origins = None
         if "content-security-policy" in response_headers:
             csp = response_headers["content-security-policy"].split()
             if len(csp) > 0 and csp[0] == "default-src":
-                self.allowed_origins = csp[1:]
+                self.allowed_origins = tuple(csp[1:])  # A tuple so fetches can be coalesced by it.
 
     def allowed_request(self, url):
         return self.allowed_origins is None or \
@@ -82,39 +133,54 @@ class Tab:
 
     def add_scripts(self, nodes, url):
         scripts = [node.attributes["src"] for node
-                   in tree_to_list(nodes, [])
-                   if isinstance(node, Element)
-                   and node.tag == "script"
-                   and "src" in node.attributes]
+                   in element_index(nodes).by_tag("script")
+                   if "src" in node.attributes]
 
         self.js = JSContext(self)
+        script_urls = []
         for script in scripts:
             script_url = resolve_url(script, url)
             if not self.allowed_request(script_url):
                 print("Blocked script", script, "due to CSP")
                 continue
-            response_header, body, view_source = request(script_url, url)
+            script_urls.append(script_url)
+
+        # Scripts are downloaded concurrently but run in document order.
+        for script_url, response in FETCHER.fetch_all(script_urls, url, started=self.preloads,
+                                                      priority=self.fetch_priority(RENDER_BLOCKING), group=self,
+                                                      allowed_origins=self.allowed_origins):
+            if isinstance(response, Exception):
+                print("Script", script_url, "failed to load", response)
+                continue
+            response_header, body, view_source = response
             print("Script returned: ", dukpy.evaljs(body))
             try:
                 self.js.run(body)
             except dukpy.JSRuntimeError as exception:
-                print("Script", script, "crashed", exception)
+                print("Script", script_url, "crashed", exception)
 
     def extend_rules(self, url):
         rules = self.default_style_sheet.copy()
         links = [node.attributes["href"]
-                 for node in tree_to_list(self.nodes, [])
-                 if isinstance(node, Element)
-                 and node.tag == "link"
-                 and "href" in node.attributes
+                 for node in element_index(self.nodes).by_tag("link")
+                 if "href" in node.attributes
                  and node.attributes.get("rel") == "stylesheet"]
 
+        style_urls = []
         for link in links:
             style_url = resolve_url(link, url)
-            try:
-                response_header, body, view_source = request(style_url, url)
-            except:
+            if not self.allowed_request(style_url):
+                print("Blocked style", link, "due to CSP")
+                continue
+            style_urls.append(style_url)
+
+        # Style sheets are downloaded concurrently but applied in document order to keep the cascade.
+        for style_url, response in FETCHER.fetch_all(style_urls, url, started=self.preloads,
+                                                     priority=self.fetch_priority(RENDER_BLOCKING), group=self,
+                                                     allowed_origins=self.allowed_origins):
+            if isinstance(response, Exception):
                 continue
+            response_header, body, view_source = response
             rules.extend(CSSParser(body).parse())
         return rules
 
@@ -139,13 +205,20 @@ class Tab:
                 continue
             cmd.execute(self.scroll - CHROME_PX, canvas)
         if self.focus:
-            obj = [obj for obj in tree_to_list(self.document, [])
-                   if obj.node == self.focus][0]
+            obj = next(obj for obj in document_order(self.document)
+                       if obj.node == self.focus)
             text = self.focus.attributes.get("value", "")
             x = obj.x + obj.font.measure(text)
             y = obj.y - self.scroll + CHROME_PX
             canvas.create_line(x, y, x, y + obj.height)
 
+    def visible_height(self):
+        return self.height - CHROME_PX
+
+    # Called when the browser is idle, with the pointer position on the page if it is over it.
+    def prefetch_links(self, pointer=None):
+        self.prefetcher.prefetch(pointer)
+
     def scroll_down(self, event):
         self._scroll(-SCROLL_STEP)
 
@@ -166,7 +239,7 @@ class Tab:
     def click(self, x, y):
         y += self.scroll
         # Find links and elements at click location.
-        objs = [obj for obj in tree_to_list(self.document, [])
+        objs = [obj for obj in document_order(self.document)
                 if obj.x <= x < obj.x + obj.width
                 and obj.y <= y < obj.y + obj.height]
         if not objs:
@@ -179,10 +252,14 @@ class Tab:
                 pass
             elif element.tag == "a" and "href" in element.attributes:
                 url = resolve_url(element.attributes["href"], self.url)
-                return self.load(url)
+                start, prefetched = time.monotonic(), was_prefetched(url)
+                self.load(url)
+                self.render()
+                NAVIGATIONS.append((url, time.monotonic() - start, prefetched))
+                return
             elif element.tag == "input":
                 self.focus = element  # Set focus on clicked element.
-                element.attributes["value"] = ""
+                set_attribute(element, "value", "")
                 return self.render()
             elif element.tag == "button":
                 while element:
@@ -192,7 +269,7 @@ class Tab:
             element = element.parent
 
     def submit_form(self, element):
-        inputs = [node for node in tree_to_list(element, [])
+        inputs = [node for node in walk(element)
                   if isinstance(node, Element)
                   and node.tag == "input"
                   and "name" in node.attributes]
@@ -211,12 +288,33 @@ class Tab:
 
     def keypress(self, char):
         if self.focus:
-            self.focus.attributes["value"] += char
+            set_attribute(self.focus, "value", self.focus.attributes.get("value", "") + char)
             self.render()
 
     def go_back(self):
         if len(self.history) > 1:
-            #self.load(self.history[-2])
-            self.history.pop()
-            back = self.history.pop()
-            self.load(back)
+            self.forward.append(self.history.pop())
+            self.restore(self.history[-1])
+
+    def go_forward(self):
+        if self.forward:
+            self.history.append(self.forward.pop())
+            self.restore(self.history[-1])
+
+    def save_page(self):
+        if self.nodes is not None and self.display_list is not None:
+            self.bfcache.store(self)
+
+    # Show a page from the history, from the back-forward cache if possible.
+    def restore(self, url):
+        FETCHER.cancel(self)  # As in load_document().
+        self.prefetcher.reset()
+        self.save_page()
+        page = self.bfcache.take(url)
+        if page:
+            page.restore(self)
+            if self.width != self.browser.width or self.height != self.browser.height:
+                self.render()
+        else:
+            self.load_document(url)
+            self.render()
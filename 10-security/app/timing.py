@@ -0,0 +1,65 @@
+import json
+import time
+from collections import deque
+
+MAX_TIMINGS = 500
+MAX_NAVIGATIONS = 100
+PHASES = ["dns", "connect", "tls", "ttfb", "download", "decompress"]
+
+
+# Durations in seconds of the phases of a single network request, plus its byte counts.
+class RequestTiming:
+    def __init__(self, method, url):
+        self.method = method
+        self.url = url
+        self.start = time.time()
+        self.end = None
+        self.status = None
+        self.cache = None
+        self.redirects = []  # Urls that led to this one, oldest first.
+        self.phases = {}
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+
+    def record(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.time()
+
+    def total(self):
+        return (self.end or time.time()) - self.start
+
+    def to_dict(self):
+        return {
+            "method": self.method,
+            "url": self.url,
+            "start": self.start,
+            "total": self.total(),
+            "status": self.status,
+            "cache": self.cache,
+            "redirects": list(self.redirects),
+            "phases": dict(self.phases),
+            "bytes_received": self.bytes_received,
+            "bytes_decoded": self.bytes_decoded,
+        }
+
+    def __repr__(self):
+        phases = ", ".join("{}={:.1f}ms".format(phase, seconds * 1000) for phase, seconds in self.phases.items())
+        return "{} {} ({})".format(self.method, self.url, phases)
+
+
+# Ring buffer that keeps the timings of the most recent requests.
+TIMINGS = deque(maxlen=MAX_TIMINGS)
+# (url, seconds, prefetched) from a click on a link until the new page is rendered.
+NAVIGATIONS = deque(maxlen=MAX_NAVIGATIONS)
+
+
+def export_timings(path):
+    with open(path, "w", encoding="UTF-8") as file:
+        json.dump(timings_to_list(), file, indent=2)
+
+
+def timings_to_list():
+    return [timing.to_dict() for timing in list(TIMINGS)]
@@ -0,0 +1,60 @@
+import ssl
+import threading
+import time
+
+
+# Shares one SSLContext between all connections, so the CA store is loaded once, and
+# remembers the last TLS session per (host, port) so new connections can resume it.
+class TLSSessionCache:
+    def __init__(self):
+        self.context = None
+        self.sessions = {}
+        self.counters = {"handshakes": 0, "resumed": 0, "handshake_time": 0}
+        self.lock = threading.Lock()
+
+    def get_context(self):
+        with self.lock:
+            if self.context is None:
+                self.context = ssl.create_default_context()
+            return self.context
+
+    def wrap(self, soc, host, port):
+        context = self.get_context()
+        with self.lock:
+            session = self.sessions.get((host, port))
+        start = time.monotonic()
+        try:
+            soc = context.wrap_socket(soc, server_hostname=host, session=session)
+        except (OSError, ValueError):
+            soc.close()
+            with self.lock:
+                self.sessions.pop((host, port), None)
+            raise
+        seconds = time.monotonic() - start
+        with self.lock:
+            self.counters["handshakes"] += 1
+            self.counters["handshake_time"] += seconds
+            if soc.session_reused:
+                self.counters["resumed"] += 1
+        self.remember(soc, host, port)
+        return soc, seconds
+
+    def remember(self, soc, host, port):
+        # With TLS 1.3 the session ticket arrives after the handshake, so this is repeated once a response was read.
+        session = soc.session
+        if session is not None and (session.has_ticket or session.id):
+            with self.lock:
+                self.sessions[(host, port)] = session
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["resumption_rate"] = stats["resumed"] / stats["handshakes"] if stats["handshakes"] else 0
+        return stats
+
+    def clear(self):
+        with self.lock:
+            self.sessions = {}
+
+
+TLS_SESSIONS = TLSSessionCache()
@@ -1,11 +1,36 @@
-import socket
-import ssl
-import gzip
+import codecs
+import html
+import threading
+import time
+import zlib
 from enum import Enum
 
+from app.archive import NetworkArchive
+from app.cache import HTTPCache
+from app.coalescer import RequestCoalescer
+from app.connection import ConnectionPool
+from app.cookies import CookieJar, registrable_domain
+from app.timing import NAVIGATIONS, PHASES, TIMINGS, RequestTiming
+from app.tls import TLS_SESSIONS
+
 CODEC = "UTF-8"
 PORT_HTTP = 80
 PORT_HTTPS = 443
+NO_BODY_STATUSES = ["204", "304"]
+REDIRECT_STATUSES = ["301", "302", "303", "307", "308"]
+PERMANENT_REDIRECT_STATUSES = ["301", "308"]
+MAX_REDIRECTS = 10
+IDEMPOTENT_METHODS = ["GET"]
+MAX_REMEMBERED_REDIRECTS = 1000
+BLOCKING = "blocking"
+ASYNCIO = "asyncio"
+FINAL_URL = ":url"  # Pseudo header with the url a response came from after redirects.
+CHUNK_SIZE = 64 * 1024
+GZIP_WBITS = zlib.MAX_WBITS | 16
+MAX_COMPRESSED_BYTES = 64 * 1024 * 1024
+MAX_DECOMPRESSED_BYTES = 128 * 1024 * 1024
+CACHE_DIR = None  # Set to a directory path to keep cached responses across restarts.
+COOKIE_FILE = None  # Set to a file path to keep persistent cookies across restarts.
 
 
 class Scheme(Enum):
@@ -18,9 +43,174 @@ class Scheme(Enum):
 
 class Special(Enum):
     BLANK = "blank"
+    NET_INTERNALS = "net-internals"
+
+
+class ResponseTooLarge(Exception):
+    pass
+
+
+class RequestBlocked(Exception):
+    pass
+
+
+# Upper bounds for the body of a single response, before and after decompression.
+class Limits:
+    def __init__(self, compressed=MAX_COMPRESSED_BYTES, decompressed=MAX_DECOMPRESSED_BYTES):
+        self.compressed = compressed
+        self.decompressed = decompressed
+
+
+DEFAULT_LIMITS = Limits()
+
+
+POOL = ConnectionPool()
+CACHE = HTTPCache(disk_path=CACHE_DIR)
+COOKIES = CookieJar(COOKIE_FILE)
+COALESCER = RequestCoalescer()
+REDIRECTS = {}  # Permanent redirects by source url.
+REDIRECTS_LOCK = threading.Lock()  # Fetcher threads read and change REDIRECTS concurrently.
+ARCHIVE = None  # See use_archive().
+BACKEND = BLOCKING  # See use_backend().
+ASYNC_ENGINE = None
+
+
+def resolve_url(url, current):
+    if "://" in url:
+        return url
+    elif url.startswith("/"):
+        scheme, host_path = current.split("://", 1)
+        host, old_path = host_path.split("/", 1)
+        return scheme + "://" + host + url
+    else:
+        directory, _ = current.rsplit("/", 1)
+        while url.startswith("../"):
+            url = url[3:]
+            if directory.count("/") == 2:
+                continue
+            directory, _ = directory.rsplit("/", 1)
+        return directory + "/" + url
+
+
+def url_origin(url):
+    scheme_colon, _, host, _ = url.split("/", 3)
+    return scheme_colon + "//" + host
+
+
+# allowed_origins, if given, lists the origins every url requested may come from, redirect targets included,
+# e.g. to enforce a CSP.
+def request(url, top_level_url=None, payload=None, limits=DEFAULT_LIMITS, allowed_origins=None):
+    scheme, url, view_source = split_scheme(url)
+
+    response_headers, body = {}, ""
+    if scheme == Scheme.HTTP.value or scheme == Scheme.HTTPS.value:
+        if payload:
+            response_headers, body = fetch_http(scheme, url, payload, limits, top_level_url, allowed_origins)
+        else:
+            # Concurrent GETs for the same url, e.g. a style sheet shared by several tabs, share one transaction.
+            key = coalescing_key(scheme + ":" + url, top_level_url, limits, allowed_origins)
+            response_headers, body = COALESCER.run(
+                key, lambda: fetch_http(scheme, url, payload, limits, top_level_url, allowed_origins))
+            response_headers = dict(response_headers)
+    elif scheme == Scheme.FILE.value:
+        body = open_file(url[2:])  # Remove the two initiating slashes.
+    elif scheme == Scheme.DATA.value:
+        content_type, data = url.split(",", 1)
+        body = handle_data(content_type, data)
+    elif scheme == Scheme.ABOUT.value:
+        body = handle_about(url)
+
+    return response_headers, body, view_source
+
+
+# Whether the request is same-site decides which cookies it carries, so it is part of the key.
+# So are the allowed origins, which may reject a redirect that another caller would follow. They are a tuple
+# rather than a check, so that tabs with the same policy share a transaction.
+def coalescing_key(url, top_level_url, limits, allowed_origins=None):
+    return url, is_same_site(url, top_level_url), limits, allowed_origins
 
 
-def request(url, payload=None):
+def fetch_http(scheme, url, payload, limits, top_level_url=None, allowed_origins=None):
+    method, full_url = "POST" if payload else "GET", scheme + ":" + url
+    if ARCHIVE and ARCHIVE.is_replaying():
+        return ARCHIVE.replay(method, full_url, payload)
+
+    start = time.monotonic()
+    if BACKEND == ASYNCIO:
+        response_headers, body = ASYNC_ENGINE.connect(full_url, payload, limits, top_level_url, allowed_origins)
+    else:
+        host, port, path, encrypted = split_host(url, scheme)
+        response_headers, body = connect(host, port, path, encrypted, payload, limits, top_level_url,
+                                         allowed_origins)
+    if ARCHIVE:
+        ARCHIVE.record(method, full_url, payload, response_headers, body, time.monotonic() - start)
+    return response_headers, body
+
+
+# Like request(), but returns the body as a generator of text pieces that are decoded while they arrive.
+def stream(url, top_level_url=None, payload=None, limits=DEFAULT_LIMITS, allowed_origins=None):
+    scheme, rest, view_source = split_scheme(url)
+    if not is_streamed(scheme):
+        response_headers, body, view_source = request(url, top_level_url, payload, limits, allowed_origins)
+        return response_headers, iter([body]), view_source
+
+    method, full_url = "POST" if payload else "GET", scheme + ":" + rest
+    if ARCHIVE and ARCHIVE.is_replaying():
+        response_headers, body = ARCHIVE.replay(method, full_url, payload)
+        return response_headers, iter([body]), view_source
+
+    start = time.monotonic()
+    host, port, path, encrypted = split_host(rest, scheme)
+    response_headers, chunks = open_stream(host, port, path, encrypted, payload, limits, top_level_url,
+                                           allowed_origins)
+    chunks = decode_chunks(chunks)
+    if ARCHIVE:
+        chunks = record_chunks(chunks, method, full_url, payload, response_headers, start)
+    return response_headers, chunks, view_source
+
+
+# Whether stream() reads a body of this scheme as it arrives. Otherwise it goes through request().
+def is_streamed(scheme):
+    return scheme in [Scheme.HTTP.value, Scheme.HTTPS.value] and BACKEND != ASYNCIO
+
+
+# Whether a fetch of this scheme can run on the asyncio engine without a thread waiting for it, see
+# fetch_async(). Archives are written and replayed by fetch_http(), so they keep the fetch on a thread.
+def is_async(scheme):
+    return scheme in [Scheme.HTTP.value, Scheme.HTTPS.value] and BACKEND == ASYNCIO and ARCHIVE is None
+
+
+# Starts a request on the asyncio engine and returns a concurrent.futures.Future with (response headers, body).
+# Cancelling the future cancels the request, which closes its connection.
+def fetch_async(url, top_level_url=None, payload=None, limits=DEFAULT_LIMITS, allowed_origins=None):
+    return ASYNC_ENGINE.submit(url, payload, limits, top_level_url, allowed_origins)
+
+
+def use_backend(backend):
+    # Switches http(s) requests between blocking sockets and the asyncio engine. Both share cache and timings.
+    global BACKEND, ASYNC_ENGINE
+    assert backend in [BLOCKING, ASYNCIO], "Unknown backend '{}'.".format(backend)
+    if backend == ASYNCIO and ASYNC_ENGINE is None:
+        from app.async_url import AsyncEngine  # The engine builds on this module, so it is imported on demand.
+        ASYNC_ENGINE = AsyncEngine()
+    BACKEND = backend
+
+
+def use_archive(path, mode, replay_latency=False):
+    # Records all http(s) responses into the archive at path or serves them from it. A path of None turns this off.
+    global ARCHIVE
+    ARCHIVE = NetworkArchive(path, mode, replay_latency) if path else None
+
+
+def record_chunks(chunks, method, url, payload, response_headers, start):
+    pieces = []
+    for chunk in chunks:
+        pieces.append(chunk)
+        yield chunk
+    ARCHIVE.record(method, url, payload, response_headers, "".join(pieces), time.monotonic() - start)
+
+
+def split_scheme(url):
     view_source = False
     scheme, url = url.split(":", 1)
     scheme = scheme.lower()
@@ -32,59 +222,200 @@ def request(url, payload=None):
         scheme, url = url.split(":", 1)
         scheme = scheme.lower()
 
-    response_headers, body = {}, ""
-    if scheme == Scheme.HTTP.value or scheme == Scheme.HTTPS.value:
-        encrypted = True if scheme == Scheme.HTTPS.value else False
-        url = url[2:]  # Remove the two initiating slashes.
+    return scheme, url, view_source
 
-        try:
-            host, path = url.split("/", 1)
-            path = "/" + path
-        except ValueError:
-            host = url
-            path = "/"
 
-        try:
-            host, port = host.split(":", 1)
-            port = int(port)
-        except ValueError:
-            if encrypted:
-                port = PORT_HTTPS
-            else:
-                port = PORT_HTTP
+def split_host(url, scheme):
+    encrypted = True if scheme == Scheme.HTTPS.value else False
+    url = url[2:]  # Remove the two initiating slashes.
 
-        response_headers, body = connect(host, port, path, encrypted, payload)
-    elif scheme == Scheme.FILE.value:
-        body = open_file(url[2:])  # Remove the two initiating slashes.
-    elif scheme == Scheme.ABOUT.value:
-        content_type, data = url.split(",", 1)
-        body = handle_data(content_type, data)
+    try:
+        host, path = url.split("/", 1)
+        path = "/" + path
+    except ValueError:
+        host = url
+        path = "/"
 
-    return response_headers, body, view_source
+    try:
+        host, port = host.split(":", 1)
+        port = int(port)
+    except ValueError:
+        if encrypted:
+            port = PORT_HTTPS
+        else:
+            port = PORT_HTTP
 
+    return host, port, path, encrypted
 
-def connect(host, port, path, encrypted, payload):
-    soc = socket.socket(
-        family=socket.AF_INET,
-        type=socket.SOCK_STREAM,
-        proto=socket.IPPROTO_TCP,
-    )
-    soc.connect((host, port))
 
-    # Encrypted connection:
-    if encrypted:
-        ctx = ssl.create_default_context()
-        soc = ctx.wrap_socket(soc, server_hostname=host)
+def connect(host, port, path, encrypted, payload, limits=DEFAULT_LIMITS, top_level_url=None,
+            allowed_origins=None):
+    response_headers, chunks = open_stream(host, port, path, encrypted, payload, limits, top_level_url,
+                                           allowed_origins)
+    return response_headers, b"".join(chunks).decode(CODEC)
+    #return response_headers, b"".join(chunks).decode(CODEC, "ignore")
 
-    # Build request headers:
+
+def open_stream(host, port, path, encrypted, payload, limits=DEFAULT_LIMITS, top_level_url=None,
+                allowed_origins=None):
+    scheme = Scheme.HTTPS.value if encrypted else Scheme.HTTP.value
+    url = format_url(scheme, host, port, path)
+    chain = []
+    while True:
+        url = skip_known_redirects(url, payload, chain)
+        check_allowed(url, allowed_origins)
+        timing = RequestTiming("POST" if payload else "GET", url)
+        timing.redirects = list(chain)
+        TIMINGS.append(timing)
+        status, response_headers, chunks = open_once(url, payload, limits, timing, top_level_url)
+        if chunks is not None:
+            if chain:
+                response_headers = dict(response_headers)
+                response_headers[FINAL_URL] = url
+            return response_headers, chunks
+
+        url, payload = follow_redirect(url, payload, status, response_headers, chain)
+
+
+def check_allowed(url, allowed_origins):
+    if allowed_origins is not None and url_origin(url) not in allowed_origins:
+        raise RequestBlocked("Request to {} is not allowed.".format(url))
+
+
+def skip_known_redirects(url, payload, chain):
+    # Moved urls that were seen before are not requested again.
+    while not payload and len(chain) < MAX_REDIRECTS:
+        with REDIRECTS_LOCK:
+            location = REDIRECTS.get(url)
+        if location is None:
+            break
+        chain.append(url)
+        url = location
+    assert len(chain) <= MAX_REDIRECTS, "Too many redirects."
+    return url
+
+
+def follow_redirect(url, payload, status, response_headers, chain):
+    location = resolve_url(response_headers["location"], url)
+    if status in PERMANENT_REDIRECT_STATUSES and not payload:
+        remember_redirect(url, location)
+    # Like other browsers, turn a redirected POST into a GET unless the status asks to keep the method.
+    if status not in ["307", "308"]:
+        payload = None
+    chain.append(url)
+    assert len(chain) <= MAX_REDIRECTS, "Too many redirects."
+    return normalize_url(location), payload
+
+
+def normalize_url(url):
+    scheme, rest, view_source = split_scheme(url)
+    assert scheme in [Scheme.HTTP.value, Scheme.HTTPS.value], "Cannot redirect to '{}'.".format(url)
+    host, port, path, encrypted = split_host(rest, scheme)
+    return format_url(scheme, host, port, path)
+
+
+def format_url(scheme, host, port, path):
+    default_port = PORT_HTTPS if scheme == Scheme.HTTPS.value else PORT_HTTP
+    if port == default_port:
+        return "{}://{}{}".format(scheme, host, path)
+    return "{}://{}:{}{}".format(scheme, host, port, path)
+
+
+def remember_redirect(url, location):
+    url, location = normalize_url(url), normalize_url(location)
+    with REDIRECTS_LOCK:
+        REDIRECTS[url] = location
+        if len(REDIRECTS) > MAX_REMEMBERED_REDIRECTS:
+            del REDIRECTS[next(iter(REDIRECTS))]
+
+
+def open_once(url, payload, limits, timing, top_level_url=None):
+    scheme, rest, view_source = split_scheme(url)
+    host, port, path, encrypted = split_host(rest, scheme)
     method = "POST" if payload else "GET"
+
+    entry, fresh, extra_headers = prepare_request(url, method, top_level_url, timing)
+    if fresh:
+        return "200", entry.headers, timed_chunks(iter([entry.body]), timing)
+
+    connection, version, status, explanation, response_headers = \
+        send_request(scheme, host, port, method, path, payload, extra_headers, timing)
+    store_cookies(url, response_headers)
+    timing.status = status
+    body = ResponseBody(connection, version, status, response_headers, limits, timing)
+
+    if status != "200":
+        body.drain()
+    response = check_response(url, status, explanation, response_headers, entry, timing)
+    if response:
+        status, response_headers, cached_body = response
+        return status, response_headers, None if cached_body is None else iter([cached_body])
+
+    # Support for HTTP compression:
+    chunks = decompress_chunks(body, response_headers.get("content-encoding", ""), limits.decompressed, timing)
+    chunks = timed_chunks(chunks, timing)
+    if may_store(url, method, response_headers, timing):
+        chunks = cache_chunks(url, response_headers, chunks)
+    return status, response_headers, chunks
+
+
+# open_once() and open_once_async() only differ in their I/O. The cache and status handling around it is here.
+def prepare_request(url, method, top_level_url, timing):
+    # Serve fresh responses from the cache and revalidate stale ones. Returns the cached entry, whether it is
+    # fresh, and the extra headers to send otherwise.
+    entry, validators = None, {}
+    if method == "GET":
+        entry = CACHE.lookup(url)
+        if entry and entry.is_fresh(time.time()):
+            entry.use()
+            CACHE.record("hits")
+            timing.cache = "hit"
+            return entry, True, None
+        elif entry:
+            validators = entry.validators()
+    return entry, False, dict(validators, **cookie_headers(url, method, top_level_url))
+
+
+def check_response(url, status, explanation, response_headers, entry, timing):
+    # Returns (status, response headers, cached body) for a response that is answered without its body: the
+    # cached body after a 304, or None for a redirect. Returns None if the body is the response.
+    if status == "304" and entry:
+        CACHE.record("revalidations")
+        CACHE.record("hits")
+        timing.cache = "revalidated"
+        timing.bytes_decoded = len(entry.body)
+        timing.finish()
+        return "200", CACHE.refresh(url, entry, response_headers), entry.body
+    if status in REDIRECT_STATUSES and "location" in response_headers:
+        timing.finish()
+        return status, response_headers, None
+    if status != "200":
+        timing.finish()
+    assert status == "200", "{}: {}".format(status, explanation)
+    return None
+
+
+def may_store(url, method, response_headers, timing):
+    if method == "GET":
+        CACHE.record("misses")
+        timing.cache = "miss"
+        if CACHE.is_storable(response_headers):
+            return True
+    CACHE.remove(url)  # Unsafe methods invalidate the stored response, and so do unstorable ones.
+    return False
+
+
+def build_request(host, method, path, payload, extra_headers):
+    # Build request headers:
     request_headers = (
             "{} {} HTTP/1.1\r\n".format(method, path) +
             "Host: {}\r\n".format(host) +
-            "Connection: close\r\n" +
+            "Connection: keep-alive\r\n" +
             "User-Agent: haw-browser\r\n"
     )
-    request_headers += "Accept-Encoding: gzip\r\n"
+    request_headers += "Accept-Encoding: gzip, deflate\r\n"
+    for header, value in extra_headers.items():
+        request_headers += "{}: {}\r\n".format(header, value)
 
     # If there is a POST request, the Content-Length header is mandatory:
     if payload:
@@ -94,60 +425,303 @@ def connect(host, port, path, encrypted, payload):
     # Add payload after headers:
     request_headers += "\r\n" + (payload or "")  # End header block with "\r\n".
 
-    soc.send(request_headers.encode(CODEC))  # Encode header block.
+    return request_headers.encode(CODEC)  # Encode header block.
 
-    #response = soc.makefile("r", encoding=CODEC, newline="\r\n")
-    response = soc.makefile("rb", newline="\r\n")
 
-    status_line = response.readline().decode(CODEC)
-    version, status, explanation = status_line.split(" ", 2)
-    assert status == "200", "{}: {}".format(status, explanation)
+def send_request(scheme, host, port, method, path, payload, extra_headers, timing):
+    request_headers = build_request(host, method, path, payload, extra_headers)
 
+    while True:
+        connection = POOL.acquire(scheme, host, port)
+        written = False
+        try:
+            sent = time.monotonic()
+            connection.send(request_headers)
+            written = True
+            status_line = connection.response.readline().decode(CODEC)
+            if not status_line:
+                raise ConnectionResetError("Connection closed by server.")
+            timing.record("ttfb", time.monotonic() - sent)
+        except OSError:
+            POOL.release(connection, False)
+            # A pooled connection may have been closed by the server in the meantime, so retry on a fresh one.
+            if connection.reused and may_retry(method, written):
+                continue
+            raise
+        break
+
+    if not connection.reused:
+        for phase, seconds in connection.setup.items():
+            timing.record(phase, seconds)
+
+    try:
+        version, status, explanation = status_line.split(" ", 2)
+        response_headers = read_headers(connection.response)
+    except Exception:
+        POOL.release(connection, False)
+        raise
+
+    return connection, version, status, explanation.strip(), response_headers
+
+
+# A POST that was sent may have been handled before the connection broke, so only GETs are sent again.
+def may_retry(method, written):
+    return method in IDEMPOTENT_METHODS or not written
+
+
+def read_headers(response):
     # Put response headers into map.
     response_headers = {}
     while True:
         line = response.readline().decode(CODEC)
-        if line == "\r\n":
+        if line == "\r\n" or line == "":
             break
         header, value = line.split(":", 1)
         # Headers are case-insensitive and whites-paces are insignificant.
-        response_headers[header.lower()] = value.strip()
-    #assert "transfer-encoding" not in response_headers
-    #assert "content-encoding" not in response_headers
+        add_header(response_headers, header.lower(), value.strip())
     #print("Response headers:" + "\r\n" + str(response_headers) + "\r\n")
+    return response_headers
 
-    # Support for HTTP compression:
-    if "content-encoding" in response_headers and "gzip" in response_headers["content-encoding"]:
-        if "transfer-encoding" in response_headers and "chunked" in response_headers["transfer-encoding"]:
-            body = read_chunks(response)
-        else:
-            body = response.read()
-        body = gzip.decompress(body).decode(CODEC)  # Decompress body.
+
+def add_header(response_headers, header, value):
+    # Set-Cookie may not be folded with commas, because Expires dates contain them, so it is kept one per line.
+    if header == "set-cookie" and header in response_headers:
+        value = response_headers[header] + "\n" + value
+    response_headers[header] = value
+
+
+def is_same_site(url, top_level_url):
+    # Requests without a page, e.g. from the address bar, count as same-site.
+    return top_level_url is None or site(url) == site(top_level_url)
+
+
+def site(url):
+    scheme, rest, view_source = split_scheme(url)
+    if scheme != Scheme.HTTP.value and scheme != Scheme.HTTPS.value:
+        return scheme
+    host, port, path, encrypted = split_host(rest, scheme)
+    return scheme, registrable_domain(host)
+
+
+def cookie_headers(url, method, top_level_url):
+    scheme, rest, view_source = split_scheme(url)
+    host, port, path, encrypted = split_host(rest, scheme)
+    cookies = COOKIES.header(scheme, host, path, is_same_site(url, top_level_url), method)
+    return {"Cookie": cookies} if cookies else {}
+
+
+def store_cookies(url, response_headers):
+    if "set-cookie" in response_headers:
+        scheme, rest, view_source = split_scheme(url)
+        host, port, path, encrypted = split_host(rest, scheme)
+        COOKIES.store(response_headers["set-cookie"].split("\n"), scheme, host, path)
+
+
+def keep_alive(version, status, response_headers):
+    connection = response_headers.get("connection", "").lower()
+    delimited = status in NO_BODY_STATUSES or \
+                "transfer-encoding" in response_headers or "content-length" in response_headers
+    if not delimited:
+        return False  # Body was delimited by closing the connection.
+    elif version == "HTTP/1.0":
+        return connection == "keep-alive"
     else:
-        body = response.read().decode(CODEC)
-        #body = response.read().decode(CODEC, "ignore")
+        return connection != "close"
+
+
+# Iterates over the raw body of a response and hands the connection back to the pool
+# once the body has been read completely, or closes it if reading stops early.
+class ResponseBody:
+    def __init__(self, connection, version, status, response_headers, limits=DEFAULT_LIMITS, timing=None):
+        self.connection = connection
+        self.version = version
+        self.status = status
+        self.response_headers = response_headers
+        self.limits = limits
+        self.timing = timing or RequestTiming(None, None)
+        self.received = 0
+        self.released = False
+
+    def __iter__(self):
+        try:
+            chunks = self.read_body(self.connection.response)
+            while True:
+                start = time.monotonic()
+                chunk = next(chunks, None)
+                self.timing.record("download", time.monotonic() - start)
+                if chunk is None:
+                    break
+                self.received += len(chunk)
+                self.timing.bytes_received = self.received
+                if self.received > self.limits.compressed:
+                    raise ResponseTooLarge("Response exceeds {} bytes.".format(self.limits.compressed))
+                yield chunk
+        except BaseException:
+            self.close()
+            raise
+        self.release(keep_alive(self.version, self.status, self.response_headers))
+
+    def read_body(self, response):
+        # The body ends after the last chunk, after Content-Length bytes or when the server closes the connection.
+        if self.status in NO_BODY_STATUSES:
+            return
+        elif "chunked" in self.response_headers.get("transfer-encoding", ""):
+            yield from read_chunks(response)
+        elif "content-length" in self.response_headers:
+            length = int(self.response_headers["content-length"])
+            if length > self.limits.compressed:
+                raise ResponseTooLarge("Response of {} bytes exceeds {} bytes.".format(length, self.limits.compressed))
+            yield from read_exactly(response, length)
+        else:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
 
-    soc.close()
+    def drain(self):
+        for _ in self:
+            pass
 
-    return response_headers, body
+    def release(self, reusable):
+        if not self.released:
+            self.released = True
+            POOL.release(self.connection, reusable)
+
+    def close(self):
+        self.release(False)
+
+    def __del__(self):
+        self.close()
 
 
 def read_chunks(response):
-    body = b''
     while True:
         line = response.readline()
-        chunk_length = int(line, 16)  # Chunk length is hexadecimal.
+        if not line:
+            raise ConnectionResetError("Connection closed before the last chunk.")
+        chunk_length = int(line.split(b";")[0], 16)  # Chunk length is hexadecimal.
 
         # A chunk size of 0 is an end indication:
         if chunk_length <= 0:
             break
         elif chunk_length > 0:
-            body += response.read(chunk_length)
+            yield from read_exactly(response, chunk_length)
 
         # Each chunk is followed by an additional empty newline (\r\n) that we have to consume.
         response.read(2)
 
-    return body
+    # Consume optional trailer headers and the final empty line so the connection can be reused.
+    while response.readline() not in [b"\r\n", b""]:
+        pass
+
+
+def read_exactly(response, length):
+    while length > 0:
+        chunk = response.read(min(length, CHUNK_SIZE))
+        if not chunk:
+            raise ConnectionResetError("Connection closed before the response was complete.")
+        length -= len(chunk)
+        yield chunk
+
+
+def decompress_chunks(body, content_encoding, max_bytes, timing):
+    decompressor = Decompressor(content_encoding, max_bytes, timing)
+    for chunk in body:
+        try:
+            yield from decompressor.decompress(chunk)
+        except ResponseTooLarge:
+            body.close()
+            raise
+    yield decompressor.flush()
+
+
+# Decompresses gzip and deflate bodies piece by piece. Output per call is capped, so a small compressed chunk
+# cannot expand into one huge buffer, and the decompressed size is checked after every piece so a
+# decompression bomb is stopped early.
+class Decompressor:
+    def __init__(self, content_encoding, max_bytes, timing):
+        if "gzip" in content_encoding:
+            self.wbits = GZIP_WBITS
+        elif "deflate" in content_encoding:
+            self.wbits = zlib.MAX_WBITS
+        else:
+            self.wbits = None
+        self.decompressor = zlib.decompressobj(self.wbits) if self.wbits else None
+        self.max_bytes = max_bytes
+        self.timing = timing
+        self.size = 0
+
+    def decompress(self, data):
+        while data:
+            if self.decompressor:
+                start = time.monotonic()
+                try:
+                    piece = self.decompressor.decompress(data, CHUNK_SIZE)
+                    self.timing.record("decompress", time.monotonic() - start)
+                except zlib.error:
+                    # Some servers send raw deflate data without the zlib header.
+                    if self.wbits != zlib.MAX_WBITS or self.size > 0:
+                        raise
+                    self.wbits = -zlib.MAX_WBITS
+                    self.decompressor = zlib.decompressobj(self.wbits)
+                    continue
+                data = self.decompressor.unconsumed_tail
+                # A gzip body may consist of several members.
+                if self.decompressor.eof and self.decompressor.unused_data:
+                    data = self.decompressor.unused_data
+                    self.decompressor = zlib.decompressobj(self.wbits)
+            else:
+                piece, data = data, b""
+
+            self.size += len(piece)
+            if self.size > self.max_bytes:
+                raise ResponseTooLarge("Decompressed response exceeds {} bytes.".format(self.max_bytes))
+            if piece:
+                yield piece
+
+    def flush(self):
+        return self.decompressor.flush() if self.decompressor else b""
+
+
+def timed_chunks(chunks, timing):
+    try:
+        for chunk in chunks:
+            timing.bytes_decoded += len(chunk)
+            yield chunk
+    finally:
+        timing.finish()
+
+
+def decode_chunks(chunks):
+    decoder = codecs.getincrementaldecoder(CODEC)()
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def cache_chunks(url, response_headers, chunks):
+    # Keep a copy for the cache only as long as the body may still be stored. A Content-Length that is
+    # already too large means the body is not buffered at all.
+    body, size = [], 0
+    if int(response_headers.get("content-length", 0)) > CACHE.max_entry_bytes:
+        CACHE.remove(url)
+        body = None
+    for chunk in chunks:
+        if body is not None:
+            size += len(chunk)
+            if size <= CACHE.max_entry_bytes:
+                body.append(chunk)
+            else:
+                body = None
+                CACHE.remove(url)
+        yield chunk
+    if body is not None:
+        CACHE.store(url, response_headers, b"".join(body))
 
 
 def open_file(path):
@@ -164,3 +738,34 @@ def open_file(path):
 
 def handle_data(content_type, data):
     return data
+
+
+def handle_about(page):
+    if page == Special.NET_INTERNALS.value:
+        return net_internals()
+    return ""
+
+
+# Lists the recorded request timings together with the cache and TLS counters.
+def net_internals():
+    out = "<!doctype html><h1>Network internals</h1>"
+    out += "<p>Cache: {}</p>".format(html.escape(str(CACHE.stats()), quote=False))
+    out += "<p>TLS: {}</p>".format(html.escape(str(TLS_SESSIONS.stats()), quote=False))
+    out += "<p>Connections: {}</p>".format(html.escape(str(POOL.stats()), quote=False))
+    out += "<p>Coalescing: {}</p>".format(html.escape(str(COALESCER.stats()), quote=False))
+    for prefetched in [True, False]:
+        seconds = [navigation[1] for navigation in list(NAVIGATIONS) if navigation[2] == prefetched]
+        if seconds:
+            out += "<p>Click to paint, {}: {} navigations, {:.1f}ms on average</p>".format(
+                "prefetched" if prefetched else "not prefetched", len(seconds), sum(seconds) / len(seconds) * 1000)
+    for timing in reversed(list(TIMINGS)):
+        phases = " ".join("{} {:.1f}ms".format(phase, timing.phases[phase] * 1000)
+                          for phase in PHASES if phase in timing.phases)
+        out += "<p><b>{} {}</b><br>".format(timing.method, html.escape(timing.url, quote=False))
+        out += "status {} cache {} total {:.1f}ms {}<br>".format(
+            timing.status, timing.cache, timing.total() * 1000, phases)
+        out += "received {} bytes decoded {} bytes".format(timing.bytes_received, timing.bytes_decoded)
+        for redirect in timing.redirects:
+            out += "<br>redirected from {}".format(html.escape(redirect, quote=False))
+        out += "</p>"
+    return out
@@ -0,0 +1,236 @@
+import gzip
+import mimetypes
+import os
+import socket
+import threading
+import time
+
+EMULATOR_PORT = 8001
+CODEC = "UTF-8"
+SEND_SIZE = 1024  # Bytes written at once when the bandwidth is capped.
+
+
+# Network conditions applied to every response. Durations are in seconds, bandwidth in bytes per second.
+class Conditions:
+    def __init__(self, latency=0, bandwidth=None, first_byte_delay=0, chunk_size=None, gzip=False):
+        self.latency = latency  # Added once per connection, like the round trip of a TCP handshake.
+        self.bandwidth = bandwidth
+        self.first_byte_delay = first_byte_delay  # Server think time before the status line.
+        self.chunk_size = chunk_size  # Send chunked bodies with chunks of this size instead of Content-Length.
+        self.gzip = gzip
+
+
+PROFILES = {
+    "lan": Conditions(),
+    "cable": Conditions(latency=0.02, bandwidth=5_000_000),
+    "dsl": Conditions(latency=0.05, bandwidth=1_000_000, first_byte_delay=0.05),
+    "3g": Conditions(latency=0.3, bandwidth=200_000, first_byte_delay=0.1, chunk_size=4096, gzip=True),
+    "2g": Conditions(latency=0.8, bandwidth=30_000, first_byte_delay=0.3, chunk_size=1024, gzip=True),
+}
+
+
+# Serves files from root, or forwards requests to an upstream origin, under the given network conditions.
+# Connections are kept alive, so connection reuse in the browser shows up in the results.
+class NetworkEmulator:
+    def __init__(self, conditions=None, root=None, upstream=None, port=0):
+        assert root or upstream, "Either a root directory or an upstream (host, port) is needed."
+        self.conditions = conditions or Conditions()
+        self.root = root
+        self.upstream = upstream
+        self.soc = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP)
+        self.soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.soc.bind(("localhost", port))
+        self.soc.listen()
+        self.port = self.soc.getsockname()[1]
+        self.connections = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.running = False
+
+    def url(self, path="/"):
+        return "http://localhost:{}{}".format(self.port, path)
+
+    def start(self):
+        # Serves on a background thread, so a benchmark can drive the browser in the same process.
+        self.running = True
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.soc.close()
+
+    def serve_forever(self):
+        self.running = True  # Also when called directly, as from the command line.
+        while self.running:
+            try:
+                conx, addr = self.soc.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handle_connection, args=(conx,), daemon=True).start()
+
+    def stats(self):
+        with self.lock:
+            return {"connections": self.connections, "requests": self.requests}
+
+    def reset_stats(self):
+        with self.lock:
+            self.connections = 0
+            self.requests = 0
+
+    def handle_connection(self, conx):
+        with self.lock:
+            self.connections += 1
+        conditions = self.conditions
+        time.sleep(conditions.latency)
+        request = conx.makefile("b")
+        try:
+            while True:
+                request_line = request.readline().decode(CODEC)
+                if not request_line.strip():
+                    break
+                method, url, version = request_line.split(" ", 2)
+                request_headers = read_headers(request)
+                body = None
+                if "content-length" in request_headers:
+                    body = request.read(int(request_headers["content-length"]))
+                with self.lock:
+                    self.requests += 1
+
+                status, response_headers, content = self.respond(method, url, request_headers, body)
+                keep_alive = request_headers.get("connection", "").lower() != "close" and \
+                    version.strip() == "HTTP/1.1"
+                time.sleep(conditions.first_byte_delay)
+                self.send(conx, status, response_headers, content, request_headers, keep_alive)
+                if not keep_alive:
+                    break
+        except (OSError, ValueError):
+            pass  # The client went away or sent something unreadable.
+        finally:
+            request.close()
+            conx.close()
+
+    def respond(self, method, url, request_headers, body):
+        if self.upstream:
+            return forward(self.upstream, method, url, request_headers, body)
+        return serve_file(self.root, method, url)
+
+    def send(self, conx, status, response_headers, content, request_headers, keep_alive):
+        conditions = self.conditions
+        if conditions.gzip and "gzip" in request_headers.get("accept-encoding", ""):
+            content = gzip.compress(content)
+            response_headers["Content-Encoding"] = "gzip"
+
+        if conditions.chunk_size:
+            response_headers["Transfer-Encoding"] = "chunked"
+            chunks = []
+            for i in range(0, len(content), conditions.chunk_size):
+                piece = content[i:i + conditions.chunk_size]
+                chunks.append("{:x}\r\n".format(len(piece)).encode(CODEC) + piece + b"\r\n")
+            data = b"".join(chunks) + b"0\r\n\r\n"
+        else:
+            response_headers["Content-Length"] = str(len(content))
+            data = content
+        response_headers["Connection"] = "keep-alive" if keep_alive else "close"
+
+        response = "HTTP/1.1 {}\r\n".format(status)
+        for header, value in response_headers.items():
+            response += "{}: {}\r\n".format(header, value)
+        response += "\r\n"
+        self.throttle(conx, response.encode(CODEC) + data)
+
+    def throttle(self, conx, data):
+        bandwidth = self.conditions.bandwidth
+        if not bandwidth:
+            conx.sendall(data)
+            return
+        start = time.monotonic()
+        for i in range(0, len(data), SEND_SIZE):
+            conx.sendall(data[i:i + SEND_SIZE])
+            # Wait until the bytes sent so far would have passed through the capped link.
+            delay = start + (i + SEND_SIZE) / bandwidth - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def read_headers(request):
+    request_headers = {}
+    for line in request:
+        line = line.decode(CODEC)
+        if line == "\r\n":
+            break
+        header, value = line.split(":", 1)
+        request_headers[header.lower()] = value.strip()
+    return request_headers
+
+
+def serve_file(root, method, url):
+    root = os.path.abspath(root)
+    path = os.path.normpath(os.path.join(root, url.split("?", 1)[0].lstrip("/")))
+    if os.path.isdir(path):
+        path = os.path.join(path, "index.html")
+    if not path.startswith(root) or not os.path.isfile(path):
+        return "404 Not Found", {"Content-Type": "text/html"}, \
+            "<!doctype html><h1>{} {} not found!</h1>".format(method, url).encode(CODEC)
+    with open(path, "rb") as file:
+        content = file.read()
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    return "200 OK", {"Content-Type": content_type}, content
+
+
+def forward(upstream, method, url, request_headers, body):
+    # Asks the upstream server for the whole response, which is then sent on under the emulated conditions.
+    host, port = upstream
+    soc = socket.create_connection((host, port))
+    request = "{} {} HTTP/1.0\r\n".format(method, url)
+    for header, value in request_headers.items():
+        if header not in ["connection", "accept-encoding", "content-length"]:
+            request += "{}: {}\r\n".format(header, value)
+    if body is not None:
+        request += "Content-Length: {}\r\n".format(len(body))
+    request += "\r\n"
+    soc.sendall(request.encode(CODEC) + (body or b""))
+
+    response = soc.makefile("b")
+    status = response.readline().decode(CODEC).split(" ", 1)[1].strip()
+    response_headers = {}
+    for line in response:
+        line = line.decode(CODEC)
+        if line == "\r\n":
+            break
+        header, value = line.split(":", 1)
+        if header.lower() not in ["content-length", "connection", "transfer-encoding"]:
+            response_headers[header] = value.strip()
+    content = response.read()
+    response.close()
+    soc.close()
+    return status, response_headers, content
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve files or proxy an origin under emulated network conditions.")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="lan")
+    parser.add_argument("--latency", type=float)
+    parser.add_argument("--bandwidth", type=int)
+    parser.add_argument("--first-byte-delay", type=float)
+    parser.add_argument("--chunk-size", type=int)
+    parser.add_argument("--gzip", action=argparse.BooleanOptionalAction)
+    parser.add_argument("--root", help="Directory to serve files from.")
+    parser.add_argument("--upstream", help="host:port of an origin to forward requests to, e.g. localhost:8000.")
+    parser.add_argument("--port", type=int, default=EMULATOR_PORT)
+    args = parser.parse_args()
+
+    conditions = PROFILES[args.profile]
+    for name in ["latency", "bandwidth", "first_byte_delay", "chunk_size", "gzip"]:
+        if getattr(args, name) is not None:
+            setattr(conditions, name, getattr(args, name))
+    upstream = None
+    if args.upstream:
+        host, port = args.upstream.rsplit(":", 1)
+        upstream = (host, int(port))
+
+    emulator = NetworkEmulator(conditions, root=args.root, upstream=upstream, port=args.port)
+    print("Serving on {}".format(emulator.url()))
+    emulator.serve_forever()
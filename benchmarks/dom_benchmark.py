@@ -0,0 +1,64 @@
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+from html_parser_benchmark import make_document
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "10-security"))
+
+from app.columnar_dom import ColumnarHTMLParser  # noqa: E402
+from app.html_parser import HTMLParser, walk  # noqa: E402
+
+PARSERS = {"object": HTMLParser, "columnar": ColumnarHTMLParser}
+
+
+def parse_time(parser_class, document, repeats):
+    best = None
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        parser_class(document).parse()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def memory(parser_class, document):
+    # Bytes still held by the parsed tree, and the most held at once while parsing.
+    gc.collect()
+    tracemalloc.start()
+    tree = parser_class(document).parse()
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return tree, retained, peak
+
+
+def walk_time(tree):
+    start = time.perf_counter()
+    nodes = sum(1 for _ in walk(tree))
+    return nodes, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare memory and parse time of the object and columnar DOM.")
+    parser.add_argument("--size", type=float, default=8, help="Document size in MB.")
+    parser.add_argument("--repeats", type=int, default=3, help="Parses per DOM; the fastest one counts.")
+    args = parser.parse_args()
+
+    document = make_document(args.size)
+    print("Document: {:.1f} MB".format(len(document.encode("UTF-8")) / (1024 * 1024)))
+    print("{:<10} {:>8} {:>10} {:>12} {:>12} {:>10}".format("DOM", "nodes", "parse s", "retained MB", "peak MB",
+                                                             "walk s"))
+    for name, parser_class in PARSERS.items():
+        seconds = parse_time(parser_class, document, args.repeats)
+        tree, retained, peak = memory(parser_class, document)
+        nodes, walk_seconds = walk_time(tree)
+        print("{:<10} {:>8} {:>10.3f} {:>12.1f} {:>12.1f} {:>10.3f}".format(
+            name, nodes, seconds, retained / (1024 * 1024), peak / (1024 * 1024), walk_seconds))
+        del tree
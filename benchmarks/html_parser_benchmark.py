@@ -0,0 +1,66 @@
+import gc
+import importlib
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHAPTERS = ["04-html", "05-layout", "06-styles", "07-chrome", "08-forms", "09-scripts", "10-security"]
+SAMPLE = (
+    "<div class=entry><h2>Entry &lt;{0}&gt;</h2>"
+    "<p>Lorem ipsum dolor sit amet, <b>consectetur</b> adipiscing elit, <i>sed do eiusmod</i> tempor "
+    "incididunt ut labore et dolore magna aliqua.<br>Ut enim ad minim veniam, quis nostrud exercitation.</p>"
+    "<form action=/add method=post><input name=guest value=\"x\"><button>Sign</button></form>"
+    "<a href=/entry/{0}>Read more</a></div>\n"
+)
+
+
+def make_document(megabytes):
+    # A guest book like page of about the given size.
+    entries = []
+    size, i = 0, 0
+    while size < megabytes * 1024 * 1024:
+        entry = SAMPLE.format(i)
+        entries.append(entry)
+        size += len(entry)
+        i += 1
+    return "<!doctype html><html><head><title>Benchmark</title></head><body>" + "".join(entries) + "</body></html>"
+
+
+def load_parser(chapter):
+    # Every chapter has its own "app" package, so the previous one has to be forgotten first.
+    for name in [name for name in sys.modules if name == "app" or name.startswith("app.")]:
+        del sys.modules[name]
+    sys.path.insert(0, os.path.join(ROOT, chapter))
+    try:
+        return importlib.import_module("app.html_parser").HTMLParser
+    finally:
+        sys.path.pop(0)
+
+
+def measure(parser_class, document, repeats):
+    best = None
+    for _ in range(repeats):
+        gc.collect()  # Do not charge this run for the garbage of the previous one.
+        start = time.perf_counter()
+        parser_class(document).parse()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Measure HTMLParser throughput of every chapter in MB/s.")
+    parser.add_argument("--size", type=float, default=4, help="Document size in MB.")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per chapter; the fastest one counts.")
+    parser.add_argument("chapters", nargs="*", default=CHAPTERS)
+    args = parser.parse_args()
+
+    document = make_document(args.size)
+    megabytes = len(document.encode("UTF-8")) / (1024 * 1024)
+    print("Document: {:.1f} MB".format(megabytes))
+    for chapter in args.chapters:
+        seconds = measure(load_parser(chapter), document, args.repeats)
+        print("{:<12} {:8.3f} s {:8.2f} MB/s".format(chapter, seconds, megabytes / seconds))